@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Check roomba.make_transparent against the original per pixel loop, and time
+both.
+Compares the output for RGB, RGBA and L images (random, with plenty of pixels
+around the white (ish) threshold), with and without a colour.
+Exits with status 1 if any output differs.
+
+usage: ./bench_make_transparent.py [-s SIZE] [-n NUMBER]
+'''
+
+import argparse
+import random
+import sys
+import timeit
+
+from PIL import Image
+
+stdout = sys.stdout     #udi_interface (imported by roomba) redirects stdout to the log
+from roomba import make_transparent, transparent
+
+def make_transparent_loop(image, colour=None):
+    '''
+    original make_transparent (before PIL band operations)
+    '''
+    image = image.convert("RGBA")
+    datas = image.getdata()
+    newData = []
+    for item in datas:
+        # white (ish)
+        if item[0] >= 254 and item[1] >= 254 and item[2] >= 254:
+            newData.append(transparent)
+        else:
+            if colour:
+                newData.append(colour)
+            else:
+                newData.append(item)
+
+    image.putdata(newData)
+    return image
+
+def test_image(mode, size, seed=0):
+    '''
+    random image, half the band values are 250-255
+    '''
+    rand = random.Random(seed)
+    bands = len(Image.new(mode, (1,1)).getbands())
+    data = bytes(rand.choice((rand.randint(0, 255), rand.randint(250, 255)))
+                 for _ in range(size[0] * size[1] * bands))
+    return Image.frombytes(mode, size, data)
+
+def main():
+    parser = argparse.ArgumentParser(description='make_transparent check and benchmark')
+    parser.add_argument('-s', '--size', type=int, default=200, help='image width and height (default: 200)')
+    parser.add_argument('-n', '--number', type=int, default=5, help='timing runs (default: 5)')
+    arg = parser.parse_args()
+
+    size = (arg.size, arg.size)
+    ok = True
+    for mode in ('RGB', 'RGBA', 'L'):
+        image = test_image(mode, size)
+        for colour in (None, (0, 0, 0, 255), (255, 0, 0, 128)):
+            same = make_transparent(image, colour).tobytes() == make_transparent_loop(image, colour).tobytes()
+            ok &= same
+            loop = min(timeit.repeat(lambda: make_transparent_loop(image, colour), number=1, repeat=arg.number))
+            bands = min(timeit.repeat(lambda: make_transparent(image, colour), number=1, repeat=arg.number))
+            print('{:4} colour: {!s:16} same: {!s:5} loop: {:8.2f}ms bands: {:6.2f}ms ({:.0f}x)'.format(
+                   mode, colour, same, loop * 1000, bands * 1000, loop / bands), file=stdout)
+    if not ok:
+        print('make_transparent output differs from the original', file=stdout)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
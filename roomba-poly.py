@@ -9,6 +9,8 @@ Updated for Polyglot v3 by Bob Paauwe
 
 import udi_interface
 import asyncio
+import hashlib
+import ipaddress
 import sys
 import json
 import socket
@@ -16,11 +18,23 @@ import ssl
 import struct
 import time
 import threading
-from roomba import Roomba
+from roomba import Roomba, tls_context, tls_generation
 
 LOGGER = udi_interface.LOGGER
 Custom = udi_interface.Custom
 aloop = None
+MAX_STARTING = 4        # robots connecting/initializing at the same time
+START_TIMEOUT = 60      # seconds to wait for a robot to report on startup
+DISCOVERY_BROADCASTS = 5    # discovery broadcasts, sent 1 second apart
+DISCOVERY_QUIET = 5     # discovery finishes when no new robot is found for this long (s)
+DISCOVERY_TIMEOUT = 30  # maximum discovery time (s)
+SWEEP_CONCURRENCY = 32  # unicast discovery probes outstanding at the same time
+SWEEP_TIMEOUT = 1       # seconds to wait for a reply to a unicast probe
+MAX_SWEEP_HOSTS = 1024  # maximum addresses in discovery_hosts (a /22)
+PASSWORD_TIMEOUT = 300  # seconds to wait for all robots to give their passwords
+PASSWORD_RETRY = 2      # seconds between password attempts
+REPROBE_OFFLINE = 120   # re-probe for a robot's ip address after it has been offline this long (s)
+REPROBE_SWEEP = 900     # re-probes sweep all of discovery_hosts at most this often (s)
 
 STATES = {  "charge": 1, #"Charging"
             "new": 2, #"New Mission"
@@ -86,15 +100,83 @@ class BasicRoomba(udi_interface.Node):
     """
     def __init__(self, poly, primary, address, name, roomba):
         super().__init__(poly, primary, address, name)
-        self.roomba = roomba
-        self.quality = -1
+        self.roomba = None
         self.connected = False
+        self._sent = {}     #driver: (value, time) last sent to Polyglot, for drivers with a deadband
+        self._pending = {}  #driver: value held back by the deadband, sent by flushDrivers
+        self._lock = threading.Lock()   #_sent and _pending are updated from the asyncio and Polyglot threads
+        self.attach(roomba)
 
         poly.subscribe(poly.START, self.start, address)
         poly.subscribe(poly.POLL, self.updateInfo)
 
+    def attach(self, roomba):
+        #Drivers are pushed from the Roomba object's change notifications as values are reported
+        if self.roomba is not None:
+            self.roomba.remove_listener(self.updateChanged)
+        self.roomba = roomba
+        self.roomba.add_listener(self.updateChanged)
+
     def start(self):
-        self.updateInfo(polltype='shortPoll')
+        self.updateDrivers()
+
+    def _changed(self, keys, *watch):
+        #keys is None for a full update, otherwise the set of keys changed on the roomba
+        return keys is None or not keys.isdisjoint(watch)
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None, text=None):
+        #Drivers listed in deadbands are only sent when the change is outside the deadband and the
+        #minimum interval has passed, otherwise the value is held until flushDrivers sends it
+        deadband = self.deadbands.get(driver)
+        with self._lock:
+            if deadband is None or force:
+                self._pending.pop(driver, None)
+                if deadband is not None:
+                    self._sent[driver] = (value, time.time())
+                return super().setDriver(driver, value, report, force, uom, text)
+
+            _now = time.time()
+            _last, _sent = self._sent.get(driver, (None, 0))
+            if _last is not None and (self._inDeadband(deadband, _last, value) or _now - _sent < deadband.get('interval', 0)):
+                if value != _last:
+                    self._pending[driver] = value
+                else:
+                    self._pending.pop(driver, None)
+                return False
+
+            self._pending.pop(driver, None)
+            self._sent[driver] = (value, _now)
+            return super().setDriver(driver, value, report, force, uom, text)
+
+    def _inDeadband(self, deadband, last, value):
+        try:
+            _change = abs(value - last)
+            if 'absolute' in deadband and _change <= deadband['absolute']:
+                return True
+            if 'percent' in deadband and _change <= abs(last) * deadband['percent'] / 100.:
+                return True
+        except TypeError:
+            pass
+        return False
+
+    def flushDrivers(self, force=False):
+        #Send held driver values whose minimum interval has passed (all of them if force)
+        _now = time.time()
+        with self._lock:
+            for driver, value in list(self._pending.items()):
+                deadband = self.deadbands[driver]
+                _last, _sent = self._sent.get(driver, (None, 0))
+                if force or (_now - _sent >= deadband.get('interval', 0) and not self._inDeadband(deadband, _last, value)):
+                    self._pending.pop(driver, None)
+                    self._sent[driver] = (value, _now)
+                    super().setDriver(driver, value)
+
+    def _watch(self, future, what):
+        #Log commands the robot hasn't acted on, future is from Roomba.send_command/set_preferences
+        def _done(fut):
+            if not fut.cancelled() and fut.exception() is None and fut.result() is False:
+                LOGGER.warning('%s has not responded to %s', self.name, what)
+        future.add_done_callback(_done)
 
     def disconnect(self):
         LOGGER.info('Attempting to disconnect from Robot')
@@ -105,7 +187,7 @@ class BasicRoomba(udi_interface.Node):
         #Roomba Start Command (not to be confused with the node start command above)
         LOGGER.info('Received Start Command on %s', self.name)
         try:
-            self.roomba.send_command("start")
+            self._watch(self.roomba.send_command("start"), "start")
             return True
         except Exception as ex:
             LOGGER.error('Error processing Roomba Start Command on %s: %s', self.name, str(ex))
@@ -115,7 +197,7 @@ class BasicRoomba(udi_interface.Node):
         #Roomba Stop Command
         LOGGER.info('Received Stop Command on %s', self.name)
         try:
-            self.roomba.send_command("stop")
+            self._watch(self.roomba.send_command("stop"), "stop")
             return True
         except Exception as ex:
             LOGGER.error('Error processing Roomba Stop Command on %s: %s', self.name, str(ex))
@@ -125,7 +207,7 @@ class BasicRoomba(udi_interface.Node):
         #Roomba Pause Command
         LOGGER.info('Received Pause Command on %s', self.name)
         try:
-            self.roomba.send_command("pause")
+            self._watch(self.roomba.send_command("pause"), "pause")
             return True
         except Exception as ex:
             LOGGER.error('Error processing Roomba Pause Command on %s: %s', self.name, str(ex))
@@ -135,7 +217,7 @@ class BasicRoomba(udi_interface.Node):
         #Roomba Resume Command
         LOGGER.info('Received Resume Command on %s', self.name)
         try:
-            self.roomba.send_command("resume")
+            self._watch(self.roomba.send_command("resume"), "resume")
             return True
         except Exception as ex:
             LOGGER.error('Error processing Roomba Resume Command on %s: %s', self.name, str(ex))
@@ -145,85 +227,90 @@ class BasicRoomba(udi_interface.Node):
         #Roomba Dock Command
         LOGGER.info('Received Dock Command on %s', self.name)
         try:
-            self.roomba.send_command("dock")
+            self._watch(self.roomba.send_command("dock"), "dock")
             return True
         except Exception as ex:
             LOGGER.error('Error processing Roomba Dock Command on %s: %s', self.name, str(ex))
             return False
 
-    def _updateBasicProperties(self):
+    def _updateBasicProperties(self, keys=None):
         #LOGGER.debug('Setting Basic Properties for %s', self.name)
 
         #ST (On/Off)
         #GV1, States (Enumeration)
-        try:
-            _state = self.roomba.master_state["state"]["reported"]["cleanMissionStatus"]["phase"]
-            LOGGER.debug('Current state on %s: %s', self.name, str(_state))
-            if _state in STATES:
-                self.setDriver('GV1', STATES[_state])
-                _running = (STATES[_state] in RUNNING_STATES)
-                self.setDriver('ST', (0,100)[int(_running)])
-        except Exception as ex:
-            LOGGER.error("Error updating current state on %s: %s", self.name, str(ex))
+        if self._changed(keys, 'phase'):
+            try:
+                _state = self.roomba.master_state["state"]["reported"]["cleanMissionStatus"]["phase"]
+                LOGGER.debug('Current state on %s: %s', self.name, str(_state))
+                if _state in STATES:
+                    self.setDriver('GV1', STATES[_state])
+                    _running = (STATES[_state] in RUNNING_STATES)
+                    self.setDriver('ST', (0,100)[int(_running)])
+            except Exception as ex:
+                LOGGER.error("Error updating current state on %s: %s", self.name, str(ex))
 
         #GV2, Connected (True/False)
-        try:
-            _connected = self.roomba.roomba_connected
-            if _connected == False and self.connected == True:
-                LOGGER.error('Roomba Disconnected: %s', self.name)
-            elif _connected == True and self.connected == False:
-                LOGGER.info('Roomba Connected: %s', self.name)
-            self.connected = _connected
+        if self._changed(keys, 'roomba_connected'):
+            try:
+                _connected = self.roomba.roomba_connected
+                if _connected == False and self.connected == True:
+                    LOGGER.error('Roomba Disconnected: %s', self.name)
+                elif _connected == True and self.connected == False:
+                    LOGGER.info('Roomba Connected: %s', self.name)
+                self.connected = _connected
 
-            self.setDriver('GV2', int(_connected))
+                self.setDriver('GV2', int(_connected))
 
-        except Exception as ex:
-            LOGGER.error("Error updating connection status on %s: %s", self.name, str(ex))
+            except Exception as ex:
+                LOGGER.error("Error updating connection status on %s: %s", self.name, str(ex))
 
         #BATLVL, Battery (Percent)
-        try:
-            _batPct = self.roomba.master_state["state"]["reported"]["batPct"]
-            self.setDriver('BATLVL', _batPct)
-        except Exception as ex:
-            LOGGER.error("Error updating battery Percentage on %s: %s", self.name, str(ex))
+        if self._changed(keys, 'batPct'):
+            try:
+                _batPct = self.roomba.master_state["state"]["reported"]["batPct"]
+                self.setDriver('BATLVL', _batPct)
+            except Exception as ex:
+                LOGGER.error("Error updating battery Percentage on %s: %s", self.name, str(ex))
 
         #GV3, Bin Present (True/False)
-        try:
-            _binPresent = self.roomba.master_state["state"]["reported"]["bin"]["present"]
-            self.setDriver('GV3', int(_binPresent))
-        except Exception as ex:
-            LOGGER.error("Error updating Bin Present on %s: %s", self.name, str(ex))
+        if self._changed(keys, 'bin'):
+            try:
+                _binPresent = self.roomba.master_state["state"]["reported"]["bin"]["present"]
+                self.setDriver('GV3', int(_binPresent))
+            except Exception as ex:
+                LOGGER.error("Error updating Bin Present on %s: %s", self.name, str(ex))
 
         #GV4, Wifi Signal (Percent)
-        try:
-            _rssi = self.roomba.master_state["state"]["reported"]["signal"]["rssi"]
-            _quality = int(max(min(2.* (_rssi + 100.),100),0))
-            if abs(_quality - self.quality) > 15: #Quality can change very frequently, only update ISY if it has changed by more than 15%
-                self.setDriver('GV4', _quality)
-                self.quality = _quality
-        except Exception as ex:
-            LOGGER.error(f"Error updating WiFi Signal Strength on {self.name}: {ex}")
+        if self._changed(keys, 'signal'):
+            try:
+                _rssi = self.roomba.master_state["state"]["reported"]["signal"]["rssi"]
+                _quality = int(max(min(2.* (_rssi + 100.),100),0))
+                self.setDriver('GV4', _quality) #Quality can change very frequently, see deadbands
+            except Exception as ex:
+                LOGGER.error(f"Error updating WiFi Signal Strength on {self.name}: {ex}")
 
         #GV5, Runtime (Hours)
-        try:
-            _hr = self.roomba.master_state["state"]["reported"]["bbrun"]["hr"]
-            _min = self.roomba.master_state["state"]["reported"]["bbrun"]["min"]
-            _runtime = round(_hr + _min/60.,1)
-            self.setDriver('GV5', _runtime)
-        except Exception as ex:
-            LOGGER.error("Error updating runtime on %s: %s", self.name, str(ex))
+        if self._changed(keys, 'bbrun'):
+            try:
+                _hr = self.roomba.master_state["state"]["reported"]["bbrun"]["hr"]
+                _min = self.roomba.master_state["state"]["reported"]["bbrun"]["min"]
+                _runtime = round(_hr + _min/60.,1)
+                self.setDriver('GV5', _runtime)
+            except Exception as ex:
+                LOGGER.error("Error updating runtime on %s: %s", self.name, str(ex))
 
         #GV6, Error Actie (True/False)
         #ALARM, Error (Enumeration)
-        try:
-            if "error" in self.roomba.master_state["state"]["reported"]["cleanMissionStatus"]:
-                _error = self.roomba.master_state["state"]["reported"]["cleanMissionStatus"]["error"]
-            else: _error = 0
+        if self._changed(keys, 'cleanMissionStatus'):
+            try:
+                if "error" in self.roomba.master_state["state"]["reported"]["cleanMissionStatus"]:
+                    _error = self.roomba.master_state["state"]["reported"]["cleanMissionStatus"]["error"]
+                else: _error = 0
 
-            self.setDriver('GV6', int(_error != 0))
-            self.setDriver('ALARM', _error)
-        except Exception as ex:
-            LOGGER.error("Error updating current Error Status on %s: %s", self.name, str(ex))
+                self.setDriver('GV6', int(_error != 0))
+                self.setDriver('ALARM', _error)
+            except Exception as ex:
+                LOGGER.error("Error updating current Error Status on %s: %s", self.name, str(ex))
     
     def delete(self):
         try:
@@ -233,11 +320,24 @@ class BasicRoomba(udi_interface.Node):
             LOGGER.error("Error attempting to stop communication to %s: %s", self.name, str(ex))
 
     def updateInfo(self, polltype):
-        if polltype == 'shortPoll':
-            self._updateBasicProperties()
+        #Drivers are pushed as the roomba reports changes (see updateChanged), the short poll sends
+        #values held back by the deadbands, the long poll does a full update in case anything was missed
+        if polltype == 'longPoll':
+            self.updateDrivers()
+            self.flushDrivers(force=True)
+        else:
+            self.flushDrivers()
+
+    def updateChanged(self, keys):
+        #Called by the Roomba object (in the event loop) with the set of keys that changed
+        self.updateDrivers(keys)
+
+    def updateDrivers(self, keys=None):
+        self._updateBasicProperties(keys)
 
     def query(self, command=None):
-        self.updateInfo(polltype='shortPoll')
+        self.updateDrivers()
+        self.flushDrivers(force=True)
         self.reportDrivers()
 
 
@@ -251,6 +351,15 @@ class BasicRoomba(udi_interface.Node):
                {'driver': 'GV6', 'value': 0, 'uom':2}, #Error Active (True/False)
                {'driver': 'ALARM', 'value': 0, 'uom':25} #Current Error (Enumeration)
                ]
+    #Change suppression for drivers that are reported frequently:
+    #absolute/percent - changes up to this size are held back, interval - minimum seconds between updates
+    deadbands = {'BATLVL': {'interval': 60},
+                 'GV4': {'absolute': 15}, #only update ISY if WiFi quality has changed by more than 15%
+                 'GV5': {'interval': 300},
+                 'GV9': {'absolute': 5, 'interval': 10},
+                 'GV10': {'absolute': 5, 'interval': 10},
+                 'ROTATE': {'absolute': 5, 'interval': 10}
+                }
     id = 'basicroomba'
     commands = {
                     'DON': setOn, 'DOF': setOff, 'PAUSE': setPause, 'RESUME': setResume, 'DOCK': setDock, 'QUERY':query
@@ -280,35 +389,37 @@ class Series800Roomba(BasicRoomba):
         #Although method is not different than the BasicRoomba class, this needs to be defined so that it can be specified in "commands" 
         super().setDock(command)
 
-    def _update800SeriesProperties(self):
+    def _update800SeriesProperties(self, keys=None):
         #LOGGER.debug('Setting Bin status and settings for %s', self.name)
 
         #GV7, Bin Full (True/False)
-        try:
-            _binFull = self.roomba.master_state["state"]["reported"]["bin"]["full"]
-            self.setDriver('GV7', int(_binFull))
-        except Exception as ex:
-            LOGGER.error("Error updating Bin Full on %s: %s", self.name, str(ex))
+        if self._changed(keys, 'bin'):
+            try:
+                _binFull = self.roomba.master_state["state"]["reported"]["bin"]["full"]
+                self.setDriver('GV7', int(_binFull))
+            except Exception as ex:
+                LOGGER.error("Error updating Bin Full on %s: %s", self.name, str(ex))
 
         #GV8, Behavior on Full Bin (Enumeration, 1=Finish, 0=Continue)
-        try:
-            _finishOnBinFull = self.roomba.master_state["state"]["reported"]["binPause"]
-            self.setDriver('GV8', int(_finishOnBinFull))
-        except Exception as ex:
-            LOGGER.error("Error updating Behavior on Bin Full Setting on %s: %s", self.name, str(ex))
+        if self._changed(keys, 'binPause'):
+            try:
+                _finishOnBinFull = self.roomba.master_state["state"]["reported"]["binPause"]
+                self.setDriver('GV8', int(_finishOnBinFull))
+            except Exception as ex:
+                LOGGER.error("Error updating Behavior on Bin Full Setting on %s: %s", self.name, str(ex))
 
-    def updateInfo(self, polltype):
-        super().updateInfo(polltype)
-        self._update800SeriesProperties()
+    def updateDrivers(self, keys=None):
+        super().updateDrivers(keys)
+        self._update800SeriesProperties(keys)
 
     def query(self, command=None):
-        super().updateInfo()
+        super().query(command)
 
     def setBinFinish(self,command=None):
         LOGGER.info('Received Command to set Bin Finish on %s: %s', self.name, str(command))
         try:
             _setting = command.get('value')
-            self.roomba.set_preference("binPause", ("false","true")[int(_setting)]) # 0=Continue, 1=Finish
+            self._watch(self.roomba.set_preference("binPause", ("false","true")[int(_setting)]), 'bin finish') # 0=Continue, 1=Finish
         except Exception as ex:
             LOGGER.error("Error setting Bin Finish Parameter on %s: %s", self.name, str(ex))
 
@@ -353,59 +464,62 @@ class Series900Roomba(Series800Roomba):
         #Although method is not different than the BasicRoomba class, this needs to be defined so that it can be specified in "commands" 
         super().setDock(command)
 
-    def _update900SeriesProperties(self):
+    def _update900SeriesProperties(self, keys=None):
         #LOGGER.debug('Setting Position status for %s', self.name)
 
-        #GV9, X Position
-        try:
-            _x = self.roomba.master_state["state"]["reported"]["pose"]["point"]["x"]
-            self.setDriver('GV9', int(_x))
-        except Exception as ex:
-            LOGGER.error("Error updating X Position on %s: %s", self.name, str(ex))
+        if self._changed(keys, 'pose'):
+            #GV9, X Position
+            try:
+                _x = self.roomba.master_state["state"]["reported"]["pose"]["point"]["x"]
+                self.setDriver('GV9', int(_x))
+            except Exception as ex:
+                LOGGER.error("Error updating X Position on %s: %s", self.name, str(ex))
 
-        #GV10, Y Position
-        try:
-            _y = self.roomba.master_state["state"]["reported"]["pose"]["point"]["y"]
-            self.setDriver('GV10', int(_y))
-        except Exception as ex:
-            LOGGER.error("Error updating Y Position on %s: %s", self.name, str(ex))
+            #GV10, Y Position
+            try:
+                _y = self.roomba.master_state["state"]["reported"]["pose"]["point"]["y"]
+                self.setDriver('GV10', int(_y))
+            except Exception as ex:
+                LOGGER.error("Error updating Y Position on %s: %s", self.name, str(ex))
 
-        #ROTATE, Theta (degrees)
-        try:
-            _theta = self.roomba.master_state["state"]["reported"]["pose"]["theta"]
-            self.setDriver('ROTATE', int(_theta))
-        except Exception as ex:
-            LOGGER.error("Error updating Theta Position on %s: %s", self.name, str(ex))
+            #ROTATE, Theta (degrees)
+            try:
+                _theta = self.roomba.master_state["state"]["reported"]["pose"]["theta"]
+                self.setDriver('ROTATE', int(_theta))
+            except Exception as ex:
+                LOGGER.error("Error updating Theta Position on %s: %s", self.name, str(ex))
 
         #LOGGER.debug('Getting Passes setting for %s', self.name)
 
         #GV11, Passes Setting (0="", 1=One, 2=Two, 3=Automatic)
-        try:
-            _noAutoPasses = self.roomba.master_state["state"]["reported"]["noAutoPasses"]
-            _twoPass = self.roomba.master_state["state"]["reported"]["twoPass"]
-            if not _noAutoPasses:
-                self.setDriver('GV11', 3)
-            elif _twoPass:
-                self.setDriver('GV11', 2)
-            else:
-                self.setDriver('GV11', 1)
-        except Exception as ex:
-            LOGGER.error("Error updating Passes Setting on %s: %s", self.name, str(ex))
+        if self._changed(keys, 'noAutoPasses', 'twoPass'):
+            try:
+                _noAutoPasses = self.roomba.master_state["state"]["reported"]["noAutoPasses"]
+                _twoPass = self.roomba.master_state["state"]["reported"]["twoPass"]
+                if not _noAutoPasses:
+                    self.setDriver('GV11', 3)
+                elif _twoPass:
+                    self.setDriver('GV11', 2)
+                else:
+                    self.setDriver('GV11', 1)
+            except Exception as ex:
+                LOGGER.error("Error updating Passes Setting on %s: %s", self.name, str(ex))
 
         #GV12, Edge Clean (On/Off)
-        try:
-            _openOnly = self.roomba.master_state["state"]["reported"]["openOnly"]
-            self.setDriver('GV12', (100,0)[int(_openOnly)]) #note 0,100 order (openOnly True means Edge Clean is Off)
-        except Exception as ex:
-            LOGGER.error("Error updating Edge Clean Setting on %s: %s", self.name, str(ex))
+        if self._changed(keys, 'openOnly'):
+            try:
+                _openOnly = self.roomba.master_state["state"]["reported"]["openOnly"]
+                self.setDriver('GV12', (100,0)[int(_openOnly)]) #note 0,100 order (openOnly True means Edge Clean is Off)
+            except Exception as ex:
+                LOGGER.error("Error updating Edge Clean Setting on %s: %s", self.name, str(ex))
 
 
-    def updateInfo(self, polltype):
-        super().updateInfo(polltype)
-        self._update900SeriesProperties()
+    def updateDrivers(self, keys=None):
+        super().updateDrivers(keys)
+        self._update900SeriesProperties(keys)
 
     def query(self, command=None):
-        super().updateInfo()
+        super().query(command)
 
     def setBinFinish(self,command=None):
         #Although method is not different than the BasicRoomba class, this needs to be defined so that it can be specified in "commands" 
@@ -416,13 +530,11 @@ class Series900Roomba(Series800Roomba):
         try:
             _setting = int(command.get('value'))
             if _setting == 1: #One Pass
-                self.roomba.set_preference("noAutoPasses", "true")
-                self.roomba.set_preference("twoPass", "false")
+                self._watch(self.roomba.set_preferences({"noAutoPasses": "true", "twoPass": "false"}), 'passes')
             elif _setting == 2: #Two Passes
-                self.roomba.set_preference("noAutoPasses", "true")
-                self.roomba.set_preference("twoPass", "true")
+                self._watch(self.roomba.set_preferences({"noAutoPasses": "true", "twoPass": "true"}), 'passes')
             elif _setting == 3: #Automatic Passes
-                self.roomba.set_preference("noAutoPasses", "false")
+                self._watch(self.roomba.set_preference("noAutoPasses", "false"), 'passes')
         except Exception as ex:
             LOGGER.error("Error setting Number of Passes on %s: %s", self.name, str(ex))
 
@@ -431,9 +543,9 @@ class Series900Roomba(Series800Roomba):
         try:
             _setting = int(command.get('value'))
             if _setting == 100:
-                self.roomba.set_preference("openOnly", "false")
+                self._watch(self.roomba.set_preference("openOnly", "false"), 'edge clean')
             else:
-                self.roomba.set_preference("openOnly", "true")
+                self._watch(self.roomba.set_preference("openOnly", "true"), 'edge clean')
         except Exception as ex:
             LOGGER.error("Error setting Edge Clean on %s: %s", self.name, str(ex))
 
@@ -483,28 +595,29 @@ class Roomba980(Series900Roomba):
         #Although method is not different than the BasicRoomba class, this needs to be defined so that it can be specified in "commands" 
         super().setDock(command)
 
-    def _update980Properties(self):
+    def _update980Properties(self, keys=None):
         #LOGGER.debug('Updating status for Roomba 980 %s', self.name)
 
         #GV13, Fan Speed Setting (0="", 1=Eco, 2=Automatic, 3=Performance)
-        try:
-            _carpetBoost = self.roomba.master_state["state"]["reported"]["carpetBoost"]
-            _vacHigh = self.roomba.master_state["state"]["reported"]["vacHigh"]
-            if _carpetBoost:
-                self.setDriver('GV13', 2)
-            elif _vacHigh:
-                self.setDriver('GV13', 3)
-            else:
-                self.setDriver('GV13', 1)
-        except Exception as ex:
-            LOGGER.error("Error updating Fan Speed Setting on %s: %s", self.name, str(ex))
+        if self._changed(keys, 'carpetBoost', 'vacHigh'):
+            try:
+                _carpetBoost = self.roomba.master_state["state"]["reported"]["carpetBoost"]
+                _vacHigh = self.roomba.master_state["state"]["reported"]["vacHigh"]
+                if _carpetBoost:
+                    self.setDriver('GV13', 2)
+                elif _vacHigh:
+                    self.setDriver('GV13', 3)
+                else:
+                    self.setDriver('GV13', 1)
+            except Exception as ex:
+                LOGGER.error("Error updating Fan Speed Setting on %s: %s", self.name, str(ex))
 
-    def updateInfo(self, polltype):
-        super().updateInfo(polltype)
-        self._update980Properties()
+    def updateDrivers(self, keys=None):
+        super().updateDrivers(keys)
+        self._update980Properties(keys)
 
     def query(self, command=None):
-        super().updateInfo()
+        super().query(command)
 
     def setBinFinish(self,command=None):
         #Although method is not different than the BasicRoomba class, this needs to be defined so that it can be specified in "commands" 
@@ -525,16 +638,13 @@ class Roomba980(Series900Roomba):
             #(0="", 1=Eco, 2=Automatic, 3=Performance)
             if _setting == 1: #Eco
                 LOGGER.info('Setting %s fan speed to "Eco"', self.name)
-                self.roomba.set_preference("carpetBoost", "false")
-                self.roomba.set_preference("vacHigh", "false")
+                self._watch(self.roomba.set_preferences({"carpetBoost": "false", "vacHigh": "false"}), 'fan speed')
             elif _setting == 2: #Automatic
                 LOGGER.info('Setting %s fan speed to "Automatic" (Carpet Boost Enabled)', self.name)
-                self.roomba.set_preference("carpetBoost", "true")
-                self.roomba.set_preference("vacHigh", "false")
+                self._watch(self.roomba.set_preferences({"carpetBoost": "true", "vacHigh": "false"}), 'fan speed')
             elif _setting == 3: #Performance
                 LOGGER.info('Setting %s fan speed to "Perfomance" (High Fan Speed)', self.name)
-                self.roomba.set_preference("carpetBoost", "false")
-                self.roomba.set_preference("vacHigh", "true")
+                self._watch(self.roomba.set_preferences({"carpetBoost": "false", "vacHigh": "true"}), 'fan speed')
         except Exception as ex:
             LOGGER.error("Error setting Number of Passes on %s: %s", self.name, str(ex))
 
@@ -585,28 +695,29 @@ class Roombai7(Series900Roomba):
         #Although method is not different than the BasicRoomba class, this needs to be defined so that it can be specified in "commands" 
         super().setDock(command)
 
-    def _updatei7Properties(self):
+    def _updatei7Properties(self, keys=None):
         #LOGGER.debug('Updating status for Roomba i7 %s', self.name)
 
         #GV13, Fan Speed Setting (0="", 1=Eco, 2=Automatic, 3=Performance)
-        try:
-            _carpetBoost = self.roomba.master_state["state"]["reported"]["carpetBoost"]
-            _vacHigh = self.roomba.master_state["state"]["reported"]["vacHigh"]
-            if _carpetBoost:
-                self.setDriver('GV13', 2)
-            elif _vacHigh:
-                self.setDriver('GV13', 3)
-            else:
-                self.setDriver('GV13', 1)
-        except Exception as ex:
-            LOGGER.error("Error updating Fan Speed Setting on %s: %s", self.name, str(ex))
+        if self._changed(keys, 'carpetBoost', 'vacHigh'):
+            try:
+                _carpetBoost = self.roomba.master_state["state"]["reported"]["carpetBoost"]
+                _vacHigh = self.roomba.master_state["state"]["reported"]["vacHigh"]
+                if _carpetBoost:
+                    self.setDriver('GV13', 2)
+                elif _vacHigh:
+                    self.setDriver('GV13', 3)
+                else:
+                    self.setDriver('GV13', 1)
+            except Exception as ex:
+                LOGGER.error("Error updating Fan Speed Setting on %s: %s", self.name, str(ex))
 
-    def updateInfo(self, polltype):
-        super().updateInfo(polltype)
-        self._updatei7Properties()
+    def updateDrivers(self, keys=None):
+        super().updateDrivers(keys)
+        self._updatei7Properties(keys)
 
     def query(self, command=None):
-        super().updateInfo()
+        super().query(command)
 
     def setBinFinish(self,command=None):
         #Although method is not different than the BasicRoomba class, this needs to be defined so that it can be specified in "commands" 
@@ -627,16 +738,13 @@ class Roombai7(Series900Roomba):
             #(0="", 1=Eco, 2=Automatic, 3=Performance)
             if _setting == 1: #Eco
                 LOGGER.info('Setting %s fan speed to "Eco"', self.name)
-                self.roomba.set_preference("carpetBoost", "false")
-                self.roomba.set_preference("vacHigh", "false")
+                self._watch(self.roomba.set_preferences({"carpetBoost": "false", "vacHigh": "false"}), 'fan speed')
             elif _setting == 2: #Automatic
                 LOGGER.info('Setting %s fan speed to "Automatic" (Carpet Boost Enabled)', self.name)
-                self.roomba.set_preference("carpetBoost", "true")
-                self.roomba.set_preference("vacHigh", "false")
+                self._watch(self.roomba.set_preferences({"carpetBoost": "true", "vacHigh": "false"}), 'fan speed')
             elif _setting == 3: #Performance
                 LOGGER.info('Setting %s fan speed to "Perfomance" (High Fan Speed)', self.name)
-                self.roomba.set_preference("carpetBoost", "false")
-                self.roomba.set_preference("vacHigh", "true")
+                self._watch(self.roomba.set_preferences({"carpetBoost": "false", "vacHigh": "true"}), 'fan speed')
         except Exception as ex:
             LOGGER.error("Error setting Number of Passes on %s: %s", self.name, str(ex))
 
@@ -665,24 +773,52 @@ class Roombai7(Series900Roomba):
 
 control = None
 polyglot = None
-robots = {}
+robots = {}             # discovered robots, by blid
+roombas = {}            # Roomba objects started by addNode, by blid
+offline = {}            # time each robot was first seen offline, by blid
+reprobing = False
+reprobe_swept = 0       # time a re-probe last swept all of discovery_hosts
 configured = False
+config_done = None      # asyncio.Event set (in aloop) when configured
+discovery_lock = None   # asyncio.Lock (in aloop) held while the discovery port is bound
 
-def _get_response(sock, roomba_message):
-    try:
-        while True:
-            raw_response, addr = sock.recvfrom(1024)
+def setConfigured(value):
+    '''
+    set configured, and signal config_done in the event loop thread, so
+    start() can wait for configuration without blocking the loop
+    '''
+    global configured
+    global config_done
+    global aloop
 
-            LOGGER.debug("Received response: %s, address: %s", raw_response, addr)
+    configured = value
+    if config_done is not None:
+        aloop.loop.call_soon_threadsafe(config_done.set if value else config_done.clear)
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    '''
+    Receives Roomba discovery responses, parsed responses are put on queue
+    waiters are futures (by ip) of unicast probes waiting for a response
+    '''
+    def __init__(self, queue, roomba_message):
+        self.queue = queue
+        self.roomba_message = roomba_message
+        self.waiters = {}
+
+    def datagram_received(self, raw_response, addr):
+        LOGGER.debug("Received response: %s, address: %s", raw_response, addr)
+        try:
             data = raw_response.decode()
+            if data == self.roomba_message:
+                return
 
-            LOGGER.info(f'Comparing {data} with {roomba_message}')
-            if data == roomba_message:
-                continue
+            waiter = self.waiters.get(addr[0])
+            if waiter is not None and not waiter.done():
+                waiter.set_result(True)
 
             json_response = json.loads(data)
             if "Roomba" in json_response["hostname"] or "iRobot" in json_response["hostname"]:
-                return {
+                self.queue.put_nowait({
                         'hostname':json_response["hostname"],
                         'robot_name':json_response["robotname"],
                         'ip':json_response["ip"],
@@ -691,69 +827,266 @@ def _get_response(sock, roomba_message):
                         'sku':json_response["sku"],
                         'blid': json_response["hostname"].split('-')[1],
                         'capabilities':json_response["cap"],
-                        }
+                        })
+        except Exception as e:
+            LOGGER.error(f'Error in response from {addr}: {e}')
 
-    except socket.timeout:
-        #LOGGER.error("Socket timeout")
-        LOGGER.error("Socket timeout while waiting for response")
-        return None
-    except Exception as e:
-        LOGGER.error(f'Error while waiting for response {e}')
-        return None
+    def error_received(self, exc):
+        LOGGER.error(f'Discover error: {exc}')
+
+
+async def _discoveryEndpoint(queue, roomba_message, udp_port):
+    loop = asyncio.get_running_loop()
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    server_socket.setsockopt(socket.IPPROTO_IP, 23, 1) # HACK 23 = IP_ONESBCAST
+    server_socket.bind(("", udp_port))
+    LOGGER.debug(f'Socket server started, port {udp_port}')
+    return await loop.create_datagram_endpoint(
+        lambda: DiscoveryProtocol(queue, roomba_message), sock=server_socket)
+
+
+async def discoverStream(udp_address, udp_port=5678, broadcasts=DISCOVERY_BROADCASTS,
+                         interval=1, quiet=DISCOVERY_QUIET, timeout=DISCOVERY_TIMEOUT):
+    '''
+    Broadcast discovery messages to udp_address, and yield each robot found
+    (once per blid) as its response arrives. Finishes when no new robot has
+    been found for quiet seconds, or after timeout seconds.
+    '''
+    loop = asyncio.get_running_loop()
+    roomba_message = "irobotmcs"
+    queue = asyncio.Queue()
+    transport, _ = await _discoveryEndpoint(queue, roomba_message, udp_port)
+
+    async def broadcast():
+        for i in range(broadcasts):
+            LOGGER.debug(f'broadcasting to bcast address {udp_address}')
+            transport.sendto(roomba_message.encode(), (udp_address, udp_port))
+            await asyncio.sleep(interval)
+
+    sender = asyncio.ensure_future(broadcast())
+    found = set()
+    deadline = loop.time() + timeout
+    last_found = loop.time()
+    try:
+        while True:
+            wait = min(last_found + quiet, deadline) - loop.time()
+            if wait <= 0:
+                break
+            try:
+                robot = await asyncio.wait_for(queue.get(), wait)
+            except asyncio.TimeoutError:
+                break
+            if robot['blid'] in found:
+                continue
+            found.add(robot['blid'])
+            last_found = loop.time()
+            yield robot
+    finally:
+        sender.cancel()
+        transport.close()
+
+
+def parseHosts(hosts):
+    '''
+    Parse comma/space separated list of ip addresses and CIDR networks
+    (eg "192.168.20.0/24, 10.0.0.5") into a list of ip addresses, entries
+    that would take it over MAX_SWEEP_HOSTS addresses are left out
+    '''
+    ips = []
+    for entry in hosts.replace(',', ' ').split():
+        try:
+            network = ipaddress.ip_network(entry, strict=False)
+            if len(ips) + network.num_addresses > MAX_SWEEP_HOSTS:
+                LOGGER.error(f'Discovery host {entry} ignored, more than {MAX_SWEEP_HOSTS} addresses to probe')
+                continue
+            ips.extend(str(ip) for ip in (network.hosts() if network.num_addresses > 1 else network))
+        except ValueError as e:
+            LOGGER.error(f'Invalid discovery host {entry}: {e}')
+    return list(dict.fromkeys(ips))
+
+
+async def sweepStream(hosts, known=(), wanted=None, full=True, udp_port=5678,
+                      limit=SWEEP_CONCURRENCY, timeout=SWEEP_TIMEOUT, retries=1):
+    '''
+    Send unicast discovery messages to the known hosts (ip addresses), then
+    (if full) to the rest of hosts, with up to limit probes outstanding at the
+    same time. Yield each robot found (once per blid) as its response arrives.
+    If wanted (set of blids) is given, finish once all of them are found.
+    '''
+    loop = asyncio.get_running_loop()
+    roomba_message = "irobotmcs"
+    queue = asyncio.Queue()
+    transport, protocol = await _discoveryEndpoint(queue, roomba_message, udp_port)
+    probes = asyncio.Semaphore(limit)
+
+    async def probe(ip):
+        async with probes:
+            for attempt in range(retries + 1):
+                waiter = protocol.waiters[ip] = loop.create_future()
+                transport.sendto(roomba_message.encode(), (ip, udp_port))
+                try:
+                    await asyncio.wait_for(waiter, timeout)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    protocol.waiters.pop(ip, None)
+
+    async def sweep():
+        known_ips = list(dict.fromkeys(known))
+        rest = [ip for ip in dict.fromkeys(hosts) if ip not in known_ips] if full else []
+        LOGGER.info(f'Probing {len(known_ips)} known and {len(rest)} other hosts for Roombas')
+        await asyncio.gather(*[probe(ip) for ip in known_ips])
+        await asyncio.gather(*[probe(ip) for ip in rest])
+        queue.put_nowait(None)
+
+    sweeper = asyncio.ensure_future(sweep())
+    found = set()
+    try:
+        while True:
+            robot = await queue.get()
+            if robot is None:
+                break
+            if robot['blid'] in found:
+                continue
+            found.add(robot['blid'])
+            yield robot
+            if wanted is not None and found >= set(wanted):
+                break
+    finally:
+        sweeper.cancel()
+        transport.close()
+
+
+def discoveryLock():
+    '''
+    Lock held by discover and reprobe while they use the discovery udp port,
+    as only one of them can bind it at a time (created in, and only used
+    from, aloop)
+    '''
+    global discovery_lock
+
+    if discovery_lock is None:
+        discovery_lock = asyncio.Lock()
+    return discovery_lock
 
 
 def discover():
     global polyglot
     global robots
+    global aloop
+    global parameters
+    global customData
 
     LOGGER.info(f'Attempting to discover Roombas')
-    nw_int = polyglot.getNetworkInterface()
-    udp_bind_address = ""
-    udp_address = nw_int['broadcast']
-    udp_port = 5678
-    roomba_message = "irobotmcs"
-    amount_of_broadcasted_messages = 5
     robots = {}
+    hosts = parseHosts(parameters['discovery_hosts'] or '')
+    if hosts:
+        # unicast probes, for robots on another subnet/VLAN
+        known = customData['discovered_ips'] or []
+        LOGGER.info(f'Discovering Roombas on {parameters["discovery_hosts"]} (known: {known})')
+        stream = lambda: sweepStream(hosts, known)
+    else:
+        nw_int = polyglot.getNetworkInterface()
+        stream = lambda: discoverStream(nw_int['broadcast'])
+
+    async def collect():
+        # waits for a re-probe to finish with the port
+        async with discoveryLock():
+            async for robot in stream():
+                robot['cap_hash'] = capHash(robot['capabilities'])
+                robots[robot['blid']] = robot
+                LOGGER.debug(f'Found robot {robot["robot_name"]}')
+                LOGGER.debug(robot)
 
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    server_socket.setsockopt(socket.IPPROTO_IP, 23, 1) # HACK 23 = IP_ONESBCAST
-    server_socket.settimeout(7)
+    try:
+        aloop.run_method(collect()).result()
+    except Exception as e:
+        LOGGER.error(f'Discover error: {e}')
 
-    # start server
-    server_socket.bind((udp_bind_address, udp_port))
-    LOGGER.debug(f'Socket server started, ip {udp_bind_address} port {udp_port}')
+    if len(robots) == 0:
+        LOGGER.error('Failed to discover any Roomba robots')
+    else:
+        LOGGER.info(f'Discovered {len(robots)} robots')
+        if hosts:
+            # responsive hosts are probed first next time
+            customData['discovered_ips'] = [robot['ip'] for robot in robots.values()]
 
-    # broadcast message and get responses
-    for i in range(amount_of_broadcasted_messages):
-        try:
-            LOGGER.debug(f'broadcasting to bcast address {udp_address}')
-            server_socket.sendto(roomba_message.encode(), (udp_address, udp_port))
 
-            # get response
-            response = _get_response(server_socket, roomba_message)
-            if response is not None:
-                robots[response['ip']] = response
-                LOGGER.debug(f'Found robot {response["robot_name"]}')
-                LOGGER.debug(response)
-                #server_socket.close()
-                #return
+def capHash(capabilities):
+    '''
+    Short hash of a robot's capabilities, to spot firmware changes that
+    add or remove features
+    '''
+    return hashlib.sha1(json.dumps(capabilities, sort_keys=True).encode()).hexdigest()[:12]
 
-            time.sleep(1)
 
-        except Exception as e:
-            LOGGER.error(f'Discover error: {e}')
+async def reprobe():
+    '''
+    Look for robots that have been offline for REPROBE_OFFLINE seconds (DHCP
+    may have given them a new ip address). A robot found at a new address
+    is pointed at it and the cache updated, other robots are not touched.
+    '''
+    global polyglot
+    global robots
+    global roombas
+    global offline
+    global parameters
+    global customData
+    global reprobing
+    global reprobe_swept
 
-    server_socket.close()
-    LOGGER.error('Failed to discover any Roomba robots')
+    now = time.time()
+    for blid, _roomba in roombas.items():
+        if _roomba.roomba_connected:
+            offline.pop(blid, None)
+        else:
+            offline.setdefault(blid, now)
+    lost = {blid for blid, since in offline.items() if now - since >= REPROBE_OFFLINE and blid in robots}
+    if not lost or reprobing:
+        return
 
+    LOGGER.info(f'Re-probing for offline robots {", ".join(robots[blid]["robot_name"] for blid in lost)}')
+    reprobing = True
+    try:
+        hosts = parseHosts(parameters['discovery_hosts'] or '')
+        if hosts:
+            # their last addresses, only sweeping every host now and then
+            full = now - reprobe_swept >= REPROBE_SWEEP
+            if full:
+                reprobe_swept = now
+            stream = sweepStream(hosts, [robots[blid]['ip'] for blid in lost], wanted=lost, full=full)
+        else:
+            stream = discoverStream(polyglot.getNetworkInterface()['broadcast'], broadcasts=2, quiet=2, timeout=10)
 
-def getPassword(robot):
-    global polyglot
-    polyglot.Notices['passwd'] = f'With the robot {robot["robot_name"]} at the base station, press and hold the Home button until the wi-fi light flashes'
+        changed = False
+        async with discoveryLock():
+            async for found in stream:
+                robot = robots.get(found['blid'])
+                if found['blid'] not in lost or robot is None:
+                    continue
+                if found['ip'] != robot['ip']:
+                    LOGGER.warning(f'{robot["robot_name"]} has moved from {robot["ip"]} to {found["ip"]}')
+                    roombas[found['blid']].set_address(found['ip'])
+                    offline[found['blid']] = time.time()
+                cap_hash = capHash(found['capabilities'])
+                if cap_hash != robot.get('cap_hash') and 'cap_hash' in robot:
+                    LOGGER.warning(f'{robot["robot_name"]} capabilities have changed, use Discover to update its node')
+                for key in ('ip', 'firmware', 'sku', 'capabilities'):
+                    robot[key] = found[key]
+                robot['cap_hash'] = cap_hash
+                changed = True
+
+        if changed:
+            customData['robots'] = robots
+    except Exception as e:
+        LOGGER.error(f'Re-probe error: {e}')
+    finally:
+        reprobing = False
 
-    # seems like we should wait here for user to press and hold the button
 
+async def getPassword(robot, deadline):
     '''
     Send MQTT magic packet to addr
     this is 0xf0 (mqtt reserved) 0x05(data length) 0xefcc3b2900 (data)
@@ -761,47 +1094,49 @@ def getPassword(robot):
     This is is 0xf0 (mqtt RESERVED) length (0x23 = 35) 0xefcc3b2900 (magic packet), 
     followed by 0xXXXX... (30 bytes of password). so 7 bytes, followed by 30 bytes of password
     total of 37 bytes
-    Uses 20 second timeout for socket connection
+    Uses 20 second timeout for connection, keeps trying until deadline
+    (loop time), returns True if the password was found
     '''
-    data = b''
+    global polyglot
+
+    loop = asyncio.get_running_loop()
+    notice = f'passwd_{robot["blid"]}'
     packet = bytes.fromhex('f005efcc3b2900')
+    context = tls_context(tls_generation(robot.get('sku')))
 
     while True:
-        LOGGER.info(f'start password discovery')
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(20)
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-        context.options |= 0x4
-        context.set_ciphers('HIGH:!DH:!aNULL')
-        wrappedSocket = context.wrap_socket(sock)
-        
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        polyglot.Notices[notice] = f'With the robot {robot["robot_name"]} at the base station, press and hold the Home button until the wi-fi light flashes ({int(remaining)}s left)'
+        LOGGER.info(f'start password discovery for {robot["robot_name"]}')
+        writer = None
         try:
             LOGGER.info(f'Connecting to {robot["ip"]} on port 8883')
-            wrappedSocket.connect((robot['ip'], 8883))
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(robot['ip'], 8883, ssl=context), min(20, remaining))
             LOGGER.debug('Connection Successful')
-            wrappedSocket.send(packet)
+            writer.write(packet)
             LOGGER.info('Waiting for response from robot')
-        
+
+            data = b''
             while len(data) < 37:
-                data_received = wrappedSocket.recv(1024)
-                data+= data_received
+                data_received = await asyncio.wait_for(reader.read(1024), max(deadline - loop.time(), 0.1))
+                data += data_received
                 if len(data_received) == 0:
                     LOGGER.debug("socket closed")
                     break
-                
-            if len(data_received) != 0:
+
+            if len(data) >= 37:
                 password = str(data[7:].decode().rstrip("\x00"))
                 if password != '':
                     robot['password'] = password
-                    LOGGER.info(f'Found password {password}')
+                    LOGGER.info(f'Found password for {robot["robot_name"]}')
+                    polyglot.Notices.delete(notice)
+                    return True
 
-                wrappedSocket.close()
-                return
-            
-        except socket.timeout as e:
-            LOGGER.error('Connection Timeout Error (for {}): {}'.format(robot['ip'], e))
+        except asyncio.TimeoutError:
+            LOGGER.error('Connection Timeout Error (for {})'.format(robot['ip']))
         except (ConnectionRefusedError, OSError) as e:
             if e.errno == 111:      #errno.ECONNREFUSED
                 LOGGER.error('Unable to Connect to roomba at ip {}, make sure nothing else is connected (app?), '
@@ -812,10 +1147,40 @@ def getPassword(robot):
                 LOGGER.error("Connection Error (for {}): {}".format(robot['ip'], e))
         except Exception as e:
             LOGGER.exception(e)
+        finally:
+            if writer is not None:
+                writer.close()
 
-        wrappedSocket.close()
+        await asyncio.sleep(max(min(PASSWORD_RETRY, deadline - loop.time()), 0))
 
-    LOGGER.error('Unable to get password from roomba')
+    LOGGER.error(f'Unable to get password from {robot["robot_name"]}')
+    polyglot.Notices[notice] = f'Unable to get password from {robot["robot_name"]}, use Discover to try again'
+    return False
+
+async def getPasswords(pending, timeout=PASSWORD_TIMEOUT):
+    '''
+    Get passwords for all pending robots at the same time, giving up after
+    timeout seconds. Each robot is saved and added as soon as its password
+    is found, so one robot that is never put in pairing mode doesn't hold up
+    the others.
+    '''
+    global customData
+    global robots
+
+    deadline = asyncio.get_running_loop().time() + timeout
+    limit = asyncio.Semaphore(MAX_STARTING)
+
+    async def acquire(robot):
+        if not await getPassword(robot, deadline):
+            return False
+        customData['robots'] = {blid: r for blid, r in robots.items() if r.get('password')}
+        return await addNode(robot, limit)
+
+    results = await asyncio.gather(*[acquire(robot) for robot in pending], return_exceptions=True)
+    for robot, result in zip(pending, results):
+        if isinstance(result, Exception):
+            LOGGER.error(f'Error getting password for {robot["robot_name"]}: {result}')
+    LOGGER.info(f'Got {len([r for r in pending if r.get("password")])} of {len(pending)} passwords')
 
 def getPasswordOld(robot):
     global polyglot
@@ -922,6 +1287,8 @@ def handleRobotData(data):
         robots = customData['robots']
         if type(robots) is dict:
             LOGGER.info(f'We have restored the saved robot list')
+            # older versions saved the robots by ip address
+            robots = {robot['blid']: robot for robot in robots.values()}
         else:
             robots = {}
     except Exception as e:
@@ -929,6 +1296,18 @@ def handleRobotData(data):
 
     LOGGER.info('Finished with handleRobotData')
 
+def handleParameters(params):
+    global parameters
+
+    parameters.load(params)
+
+def handlePoll(polltype):
+    global aloop
+    global configured
+
+    if polltype == 'longPoll' and configured:
+        aloop.run_method(reprobe())
+
 def handleConfigDone():
     global polyglot
     global robots
@@ -938,78 +1317,111 @@ def handleConfigDone():
         LOGGER.info('No saved robots...')
         discoverRobots()
 
-    polyglot.Notices.clear()
-
-    configured = True
-
-async def wait_for_state(_roomba):
-    while 'state' not in _roomba.master_state:
-        LOGGER.info(f'Waiting for data to populate {_roomba.master_state}')
-        await asyncio.sleep(1)
+    setConfigured(True)
 
-    while 'reported' not in _roomba.master_state['state']:
-        await asyncio.sleep(1)
-
-async def addNodes(robots):
+def createNode(_roomba, _name, _address):
     global polyglot
-    global aloop
 
-    LOGGER.info(f'Discovery fround {len(robots)} robots!')
-    for robot in robots.values():
-        polyglot.Notices['setup'] = f'Initializing connection to {robot["robot_name"]}'
-        await asyncio.sleep(2)
-        LOGGER.info(f'Create a new node for {robot["robot_name"]} ...')
+    if len(_roomba.master_state["state"]["reported"].get("cap", {})) > 0:
+        LOGGER.info(f'Here is where we reall create the node')
+        try:
+            if polyglot.getNode(_address):
+                polyglot.getNode(_address).attach(_roomba)
+                LOGGER.info(f'_name already exist, skipping.')
+                return True
+
+            LOGGER.debug(f'Getting capabilities from {_name}')
+            _hasPos = _getCapability(_roomba, 'pose')
+            _hasCarpetBoost = _getCapability(_roomba, 'carpetBoost')
+            _hasBinFullDetect = _getCapability(_roomba, 'binFullDetect')
+            _hasDockComm = _getCapability(_roomba, 'dockComm')
+            LOGGER.debug(f'Capabilities: Position: {_hasPos}, CarpetBoost: {_hasCarpetBoost}, BinFullDetection: {_hasBinFullDetect}')
+
+            LOGGER.info(f'pick the right node class depending on capabilities')
+            if  _hasDockComm:
+                LOGGER.info(f'Adding Roomba i7: {_name} ({_address})')
+                polyglot.addNode(Roombai7(polyglot, _address, _address, _name, _roomba))
+            elif  _hasCarpetBoost:
+                LOGGER.info(f'Adding Roomba 980: {_name} ({_address})')
+                polyglot.addNode(Roomba980(polyglot, _address, _address, _name, _roomba))
+            elif _hasPos:
+                LOGGER.info(f'Adding Series 900 Roomba: {_name} ({_address})')
+                polyglot.addNode(Series900Roomba(polyglot, _address, _address, _name, _roomba))
+            elif _hasBinFullDetect:
+                LOGGER.info(f'Adding Series 800 Roomba: {_name} ({_address})')
+                polyglot.addNode(Series800Roomba(polyglot, _address, _address, _name, _roomba))
+            else:
+                LOGGER.info(f'Adding Base Roomba: {_name} ({_address})')
+                polyglot.addNode(BasicRoomba(polyglot, _address, _address, _name, _roomba))
+            return True
+        except Exception as ex:
+            LOGGER.error(f'Error adding {_name} after discovery: {ex}')
+    else:
+        LOGGER.debug(f'Information not yet received for {_name}')
+    return False
 
-        _name = robot['robot_name']
-        LOGGER.info('Robot name = {}'.format(_name))
-        _address = 'rm' + robot['blid'][-10:].lower()
-        LOGGER.info('Robot address = {}'.format(_address))
+async def addNode(robot, limit):
+    '''
+    Connect to a robot and add its node once it reports its capabilities.
+    limit (a semaphore) bounds the number of robots starting at once, a
+    robot that takes longer than START_TIMEOUT frees its slot and is added
+    when it does report.
+    '''
+    global roombas
+
+    _name = robot['robot_name']
+    if robot['blid'] in roombas:
+        LOGGER.debug(f'{_name} already started')
+        return True
+    if not robot.get('password'):
+        LOGGER.warning(f'No password for {_name}, use Discover to get it')
+        return False
+    LOGGER.info('Robot name = {}'.format(_name))
+    _address = 'rm' + robot['blid'][-10:].lower()
+    LOGGER.info('Robot address = {}'.format(_address))
 
+    async with limit:
+        start_time = time.time()
+        LOGGER.info(f'Create a new node for {_name} ...')
         # Create a Roomba object and connect to robot
         LOGGER.info('Create Roomba Object {} {} {} {}'.format(robot['ip'], robot['blid'], robot['password'], robot['robot_name']))
-        _roomba = await Roomba(robot['ip'], robot['blid'], robot['password'], roombaName=robot['robot_name'], log=LOGGER)
+        _roomba = Roomba(robot['ip'], robot['blid'], robot['password'], roombaName=robot['robot_name'], log=LOGGER)
+        _roomba.tls_generation = tls_generation(robot.get('sku'))
+        roombas[robot['blid']] = _roomba
         LOGGER.info(f'Connecting to robot ...')
-        await _roomba.connect()
+        _roomba.connect()
+        # node is created as soon as the robot reports its capabilities
+        if not await _roomba.wait_ready(START_TIMEOUT):
+            LOGGER.warning(f'{_name} has not reported after {START_TIMEOUT}s, it will be added when it does')
 
-        await asyncio.create_task(wait_for_state(_roomba))
+            def _ready(fut):
+                if not fut.cancelled():
+                    LOGGER.info(f'{_name} ready after {time.time() - start_time:.1f}s')
+                    createNode(_roomba, _name, _address)
 
-        if len(_roomba.master_state["state"]["reported"]["cap"]) > 0:
-            LOGGER.info(f'Here is where we reall create the node')
-            try:
-                if polyglot.getNode(_address):
-                    polyglot.getNode(_address).roomba = _roomba
-                    LOGGER.info(f'_name already exist, skipping.')
-                    continue
+            _roomba.ready.add_done_callback(_ready)
+            return False
 
-                LOGGER.debug(f'Getting capabilities from {_name}')
-                _hasPos = _getCapability(_roomba, 'pose')
-                _hasCarpetBoost = _getCapability(_roomba, 'carpetBoost')
-                _hasBinFullDetect = _getCapability(_roomba, 'binFullDetect')
-                _hasDockComm = _getCapability(_roomba, 'dockComm')
-                LOGGER.debug(f'Capabilities: Position: {_hasPos}, CarpetBoost: {_hasCarpetBoost}, BinFullDetection: {_hasBinFullDetect}')
-
-                LOGGER.info(f'pick the right node class depending on capabilities')
-                if  _hasDockComm:
-                    LOGGER.info(f'Adding Roomba i7: {_name} ({_address})')
-                    polyglot.addNode(Roombai7(polyglot, _address, _address, _name, _roomba))
-                elif  _hasCarpetBoost:
-                    LOGGER.info(f'Adding Roomba 980: {_name} ({_address})')
-                    polyglot.addNode(Roomba980(polyglot, _address, _address, _name, _roomba))
-                elif _hasPos:
-                    LOGGER.info(f'Adding Series 900 Roomba: {_name} ({_address})')
-                    polyglot.addNode(Series900Roomba(polyglot, _address, _address, _name, _roomba))
-                elif _hasBinFullDetect:
-                    LOGGER.info(f'Adding Series 800 Roomba: {_name} ({_address})')
-                    polyglot.addNode(Series800Roomba(polyglot, _address, _address, _name, _roomba))
-                else:
-                    LOGGER.info(f'Adding Base Roomba: {_name} ({_address})')
-                    polyglot.addNode(BasicRoomba(polyglot, _address, _address, _name, _roomba))
-            except Exception as ex:
-                LOGGER.error(f'Error adding {_name} after discovery: {ex}')
-        else:
-            LOGGER.debug(f'Information not yet received for {_name}')
+    LOGGER.info(f'{_name} ready after {time.time() - start_time:.1f}s')
+    return createNode(_roomba, _name, _address)
+
+async def addNodes(robots):
+    global polyglot
+    global aloop
+
+    LOGGER.info(f'Discovery fround {len(robots)} robots!')
+    if len(robots) == 0:
+        return
+    start_time = time.time()
+    polyglot.Notices['setup'] = f'Initializing connection to {", ".join(robot["robot_name"] for robot in robots.values())}'
+    limit = asyncio.Semaphore(MAX_STARTING)
+    results = await asyncio.gather(*[addNode(robot, limit) for robot in robots.values()], return_exceptions=True)
+    for robot, result in zip(robots.values(), results):
+        if isinstance(result, Exception):
+            LOGGER.error(f'Error starting {robot["robot_name"]}: {result}')
+    LOGGER.info(f'Started {results.count(True)} of {len(robots)} robots in {time.time() - start_time:.1f}s')
 
-        polyglot.Notices.clear()
+    polyglot.Notices.delete('setup')
 
 def discoverRobots():
     global polyglot
@@ -1017,18 +1429,27 @@ def discoverRobots():
     global customData
     global configured
     global aloop
+    global roombas
 
     # make sure we disconnect from the Roomba
     for node in polyglot.nodes():
         node.disconnect()
-    configured = False
+    roombas = {}
+    offline.clear()
+    setConfigured(False)
+    polyglot.Notices.clear()
 
     discover()
 
-    for robot in robots.values():
-        if 'password' not in robot or robot['password'] == '':
-            getPassword(robot)
+    pending = [robot for robot in robots.values() if not robot.get('password')]
+    if pending:
+        try:
+            aloop.run_method(getPasswords(pending)).result()
+        except Exception as e:
+            LOGGER.error(f'Password error: {e}')
 
+    # robots without a password are left out, so the next Discover retries them
+    robots = {blid: robot for blid, robot in robots.items() if robot.get('password')}
     customData['robots'] = robots
 
 async def _start_the_nodes(robots):
@@ -1041,23 +1462,24 @@ def userDiscover():
 
     discoverRobots()
 
-    polyglot.Notices.clear()
-
     if len(robots.keys()) == 0:
         LOGGER.warning(f'No robots discovered.')
         return
 
-    configured = True
+    setConfigured(True)
     aloop.run_method(addNodes(robots))
 
 async def start():
     global robots
     global configured
+    global config_done
 
     LOGGER.info('Roomba node server starting')
-    # make sure configure is done
-    while not configured:
-        time.sleep(5)
+    # make sure configure is done, without blocking the event loop
+    config_done = asyncio.Event()
+    if configured:
+        config_done.set()
+    await config_done.wait()
 
     await addNodes(robots)
 
@@ -1067,12 +1489,15 @@ if __name__ == "__main__":
         polyglot.start('2.0.17')
 
         customData = Custom(polyglot, 'customdata')
+        parameters = Custom(polyglot, 'customparams')
         #control = Controller(polyglot)
 
         # Add subscriptions for CONFIGDONE and CUSTOMDATA
         polyglot.subscribe(polyglot.CUSTOMDATA, handleRobotData)
+        polyglot.subscribe(polyglot.CUSTOMPARAMS, handleParameters)
         polyglot.subscribe(polyglot.CONFIGDONE, handleConfigDone)
         polyglot.subscribe(polyglot.DISCOVER, userDiscover)
+        polyglot.subscribe(polyglot.POLL, handlePoll)
         
         polyglot.updateProfile()
         polyglot.setCustomParamsDoc()
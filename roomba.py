@@ -41,20 +41,27 @@ Nick Waterton 19th Jun 2024 V 2.0.2: Python 3.10 compatibility fixes and TLS fix
 __version__ = "2.0.2"
 
 import asyncio
+import concurrent.futures
 from ast import literal_eval
 #from collections import OrderedDict, Mapping
+from collections import OrderedDict, deque
 from collections.abc import Mapping
 from password import Password
 import datetime
+import hashlib
+import itertools
 import json
 import math
 import logging
+import multiprocessing
 import os
+import random
 import socket
 import ssl
 import sys
 import time
 import textwrap
+import threading
 import io
 import configparser
 import udi_interface
@@ -82,7 +89,7 @@ except ImportError:
     print("CV or numpy module not found, falling back to PIL")
 
 try:
-    from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageOps, ImageColor
+    from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageOps, ImageColor, ImageChops
     HAVE_PIL = True
 except ImportError:
     print("PIL module not found, maps are disabled")
@@ -99,33 +106,55 @@ if sys.version_info < (3, 7):
     asyncio.get_running_loop = asyncio.get_event_loop
     
 transparent = (0, 0, 0, 0)  #transparent colour
+white_lut = [255 if p >= 254 else 0 for p in range(256)]  #white (ish) mask lookup table
 
 def make_transparent(image, colour=None):
     '''
     take image and make white areas transparent
     return transparent image
     '''
-    image = image.convert("RGBA")
-    datas = image.getdata()
+    try:
+        image = image.convert("RGBA")
+    except ValueError:
+        # PIL can't convert this mode (eg 'La') to RGBA
+        return make_transparent_pixels(image, colour)
+    # white (ish) mask, from the darkest of the r,g,b bands
+    r, g, b, _ = image.split()
+    mask = ImageChops.darker(ImageChops.darker(r, g), b).point(white_lut)
+    if colour:
+        image = Image.new("RGBA", image.size, colour)
+    image.paste(transparent, mask=mask)
+    return image
+
+def make_transparent_pixels(image, colour=None):
+    '''
+    make_transparent a pixel at a time, for any band layout
+    a missing r, g or b band is taken from the first band (grey), no alpha
+    band is opaque
+    '''
+    bands = image.getbands()
+    rgb = [bands.index(band) if band in bands else 0 for band in 'RGB']
+    alpha = next((bands.index(band) for band in 'Aa' if band in bands), None)
     newData = []
-    for item in datas:
+    for item in image.getdata():
+        if not isinstance(item, tuple):
+            item = (item,)
+        pixel = tuple(min(int(item[i]), 255) for i in rgb) + (255 if alpha is None else min(int(item[alpha]), 255),)
         # white (ish)
-        if item[0] >= 254 and item[1] >= 254 and item[2] >= 254:
+        if min(pixel[:3]) >= 254:
             newData.append(transparent)
         else:
-            if colour:
-                newData.append(colour)
-            else:
-                newData.append(item)
-
-    image.putdata(newData)
-    return image
+            newData.append(colour or pixel)
+    result = Image.new("RGBA", image.size)
+    result.putdata(newData)
+    return result
     
 class icons():
     '''
     Roomba icons object
     '''
-    def __init__(self, base_icon=None, angle=0, fnt=None, size=(50,50), log=None):
+    def __init__(self, base_icon=None, angle=0, fnt=None, size=(50,50), log=None,
+                       buckets=360, cache_size=None):
         #super().__init__()
         if log:
             LOGGER = log
@@ -135,12 +164,15 @@ class icons():
         self.fnt = fnt
         self.size = size
         self.base_icon = base_icon
+        self.sprites = OrderedDict()    #rotated icons by (name, theta bucket), LRU
+        self.set_buckets(buckets, cache_size)
         if self.base_icon is None:
             self.base_icon = self.draw_base_icon()
         
         self.init_dict()
                         
     def init_dict(self):
+        self.sprites.clear()
         self.icons = {  'roomba'    : self.create_icon('roomba'),
                         'stuck'     : self.create_icon('stuck'),
                         'cancelled' : self.create_icon('cancelled'),
@@ -160,7 +192,37 @@ class icons():
     def set_angle(self, angle):
         self.angle = angle
         
+    def set_buckets(self, buckets=360, cache_size=None):
+        '''
+        rotated icons are cached at buckets angles (360 is every degree, 72
+        every 5 degrees), keeping the cache_size (default buckets) most
+        recently used.
+        '''
+        self.buckets = max(1, int(buckets))
+        self.cache_size = max(1, int(cache_size if cache_size else self.buckets))
+        self.sprites.clear()
+        
+    def rotated(self, name, theta):
+        '''
+        return icon name rotated by theta (rounded to the nearest bucket)
+        '''
+        bucket = round(theta * self.buckets / 360) % self.buckets
+        key = (name, bucket)
+        sprite = self.sprites.get(key)
+        if sprite is not None:
+            self.sprites.move_to_end(key)
+            return sprite
+        icon = self.icons.get(name)
+        if icon is None:
+            return None
+        sprite = icon.rotate(bucket * 360 / self.buckets, expand=False)
+        self.sprites[key] = sprite
+        if len(self.sprites) > self.cache_size:
+            self.sprites.popitem(last=False)
+        return sprite
+        
     def create_default_icon(self, name, size=None):
+        self.sprites.clear()
         self.icons[name] = self.create_icon(name, size)
             
     def load_icon_file(self, name, filename, size=None):
@@ -170,6 +232,7 @@ class icons():
             icon = Image.open(filename).convert('RGBA').resize(size, LANCZOS)
             icon = make_transparent(icon)
             icon = icon.rotate(180-self.angle, expand=False)
+            self.sprites.clear()
             self.icons[name] = icon
             return True
         except IOError as e:
@@ -273,6 +336,643 @@ class icons():
         return icon
 
 
+class FrameStore(object):
+    '''
+    Latest encoded map images by name (eg 'map.png'), with an ETag, so they
+    can be served from memory (see web_server). Thread safe, images are put
+    by the map writer thread.
+    '''
+    def __init__(self):
+        self.frames = {}        #name: (data, etag, content_type)
+        self.updated = set()    #names put since pop_updated
+        self.lock = threading.Lock()
+        
+    def put(self, name, data, content_type='image/png'):
+        etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+        with self.lock:
+            self.frames[name] = (data, etag, content_type)
+            self.updated.add(name)
+            
+    def get(self, name):
+        '''
+        returns (data, etag, content_type) or None
+        '''
+        with self.lock:
+            return self.frames.get(name)
+            
+    def names(self):
+        with self.lock:
+            return sorted(self.frames)
+            
+    def pop_updated(self):
+        '''
+        returns {name: data} of images put since the last call
+        '''
+        with self.lock:
+            updated = {name: self.frames[name][0] for name in self.updated}
+            self.updated = set()
+        return updated
+    
+
+class MapWriter(object):
+    '''
+    Writes map images in a background thread, so PNG encoding and file
+    writes are off the map drawing path. At most max_fps frames a second are
+    written (0 is unlimited), frames submitted in between replace the
+    pending frame, so only the latest one is written.
+    '''
+    def __init__(self, write, max_fps=1.0, name='map_writer'):
+        self.write = write          #called with the submitted args
+        self.name = name
+        self.pending = None
+        self.last_write = 0
+        self.written = self.skipped = 0
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()  #held while taking and writing a frame
+        self.thread = None
+        self.set_max_fps(max_fps)
+        
+    def set_max_fps(self, max_fps):
+        self.interval = 1 / max_fps if max_fps else 0
+        
+    def submit(self, *args):
+        with self.cond:
+            if self.pending is not None:
+                self.skipped += 1
+            self.pending = args
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+            
+    def run(self):
+        while True:
+            with self.cond:
+                while self.pending is None:
+                    if not self.cond.wait(60):
+                        #idle, exit thread (restarted by submit)
+                        self.thread = None
+                        return
+                wait = self.last_write + self.interval - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+            self.flush(True)
+            
+    def flush(self, force=False):
+        '''
+        write the pending frame (if any) now if max_fps allows it (or force),
+        after any write in progress has finished.
+        returns seconds until a pending frame held back by max_fps is due, or 0
+        '''
+        with self.write_lock:
+            with self.cond:
+                if self.pending is None:
+                    return 0
+                wait = self.last_write + self.interval - time.monotonic()
+                if wait > 0 and not force:
+                    return wait
+                args, self.pending = self.pending, None
+                self.last_write = time.monotonic()
+            try:
+                self.write(*args)
+                self.written += 1
+            except Exception as e:
+                LOGGER.exception(e)
+        return 0
+    
+
+class MessageQueue(object):
+    '''
+    Bounded asyncio queue for incoming messages
+    policy is what happens when a message is put:
+    'drop-oldest' : if the queue is full, the oldest message is discarded
+    'coalesce'    : a queued message with the same key (from the key function)
+                    is superseded by the new one, if there is no match and
+                    the queue is full, the oldest message is discarded
+    'block'       : put() waits until there is room in the queue
+    dropped and coalesced count the messages discarded and superseded
+    '''
+    policies = ['drop-oldest', 'coalesce', 'block']
+
+    def __init__(self, maxsize=100, policy='coalesce', key=None):
+        self.items = OrderedDict()
+        self.count = itertools.count()      #keys for messages that don't coalesce
+        self.key = key
+        self.not_empty = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+        self.dropped = 0
+        self.coalesced = 0
+        self.configure(maxsize, policy)
+
+    def configure(self, maxsize=None, policy=None):
+        if maxsize is not None:
+            self.maxsize = int(maxsize)
+        if policy is not None:
+            if policy not in self.policies:
+                raise ValueError('queue policy must be one of {}'.format(self.policies))
+            self.policy = policy
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
+
+    async def put(self, item):
+        while self.policy == 'block' and self.full():
+            self.not_full.clear()
+            await self.not_full.wait()
+        self.put_nowait(item)
+
+    def put_nowait(self, item):
+        key = None
+        if self.policy == 'coalesce' and self.key is not None:
+            key = self.key(item)
+            if key is not None and key in self.items:
+                self.items[key] = item
+                self.items.move_to_end(key)
+                self.coalesced += 1
+                return
+        if self.full():
+            if self.policy == 'block':
+                raise asyncio.QueueFull
+            self.items.popitem(last=False)
+            self.dropped += 1
+        self.items[key if key is not None else next(self.count)] = item
+        self.not_empty.set()
+
+    async def get(self):
+        while not self.items:
+            self.not_empty.clear()
+            await self.not_empty.wait()
+        _, item = self.items.popitem(last=False)
+        self.not_full.set()
+        return item
+
+
+# TLS settings by robot generation (see tls_generation). Legacy (980 and
+# earlier) robots only do TLS 1.2, with keys too small for the default security
+# level (dh_key_too_small), so they get SECLEVEL=1 and TLS 1.2 at most (no
+# TLS 1.3 attempt, and their sessions can be resumed).
+tls_settings = {'legacy':  {'ciphers': 'DEFAULT@SECLEVEL=1', 'maximum_version': ssl.TLSVersion.TLSv1_2},
+                'default': {'ciphers': 'HIGH:!DH:!aNULL'}}
+tls_contexts = {}       #shared SSLContext by generation
+tls_lock = threading.Lock()
+
+def tls_generation(sku=None):
+    '''
+    robot generation from sku, 'legacy' for the R (600/800/900) series
+    '''
+    return 'legacy' if str(sku or '').upper().startswith('R') else 'default'
+
+def tls_context(generation='default'):
+    '''
+    returns the process wide SSLContext for robots of generation, built once
+    and shared by all robots (and password retrieval)
+    '''
+    with tls_lock:
+        context = tls_contexts.get(generation)
+        if context is None:
+            settings = tls_settings.get(generation, tls_settings['default'])
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            context.options |= 0x4
+            context.set_ciphers(settings['ciphers'])
+            if 'maximum_version' in settings:
+                context.maximum_version = settings['maximum_version']
+            context.sslsocket_class = TLSSocket
+            tls_contexts[generation] = context
+        return context
+
+
+class TLSSocket(ssl.SSLSocket):
+    '''
+    SSLSocket that reports its handshake to its TLSSession
+    '''
+    tls_session = None
+
+    def do_handshake(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = super().do_handshake(*args, **kwargs)
+        if self.tls_session is not None:
+            self.tls_session.handshake_done(self, time.perf_counter() - start)
+        return result
+
+
+class TLSSession(object):
+    '''
+    One robot's view of a shared SSLContext (given to paho as its context):
+    wrap_socket offers the robot's last TLS session, so a reconnect can
+    resume it (an abbreviated handshake) if the robot supports it.
+    Handshake times are recorded.
+    '''
+    def __init__(self, context, name=''):
+        self.context = context
+        self.name = name
+        self.session = None
+        self.handshakes = 0
+        self.resumed = 0
+        self.last_handshake = None
+        self.handshake_time = 0     #total (s)
+
+    @property
+    def check_hostname(self):
+        return self.context.check_hostname
+
+    @check_hostname.setter
+    def check_hostname(self, value):
+        self.context.check_hostname = value
+
+    def wrap_socket(self, sock, **kwargs):
+        if self.session is not None:
+            kwargs['session'] = self.session
+        ssl_sock = self.context.wrap_socket(sock, **kwargs)
+        ssl_sock.tls_session = self
+        return ssl_sock
+
+    def handshake_done(self, ssl_sock, elapsed):
+        self.handshakes += 1
+        self.handshake_time += elapsed
+        self.last_handshake = elapsed
+        if ssl_sock.session_reused:
+            self.resumed += 1
+        LOGGER.info('{} TLS handshake {:.1f}ms{}'.format(
+                    self.name, elapsed * 1000, ' (resumed)' if ssl_sock.session_reused else ''))
+        self.update(ssl_sock)
+
+    def update(self, ssl_sock):
+        '''
+        keep the current session of ssl_sock (TLS 1.3 sends it after the
+        handshake)
+        '''
+        try:
+            if ssl_sock is not None and ssl_sock.session is not None:
+                self.session = ssl_sock.session
+        except (AttributeError, ValueError, OSError):
+            pass
+
+    def stats(self):
+        return {'handshakes': self.handshakes,
+                'resumed': self.resumed,
+                'last_handshake': self.last_handshake,
+                'mean_handshake': self.handshake_time / self.handshakes if self.handshakes else None}
+
+
+class AsyncioHelper(object):
+    '''
+    Runs a paho client's network i/o in the asyncio loop, instead of a
+    loop_start() thread per client. The socket callbacks (which can be called
+    from any thread) add/remove the socket as a reader/writer of the loop,
+    and loop_misc (keepalive) runs every second while the socket is open.
+    '''
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        self.paused = False
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self._open, sock.fileno())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self._close, sock.fileno())
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.add_writer, sock.fileno(), self.write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_writer, sock.fileno())
+
+    def _open(self, fd):
+        self.paused = False
+        self.loop.add_reader(fd, self.read)
+        if self.misc is None or self.misc.done():
+            self.misc = self.loop.create_task(self.misc_loop())
+
+    def _close(self, fd):
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+
+    def read(self):
+        self.client.loop_read()
+        #TLS can have decrypted data buffered that select won't report
+        sock = self.client.socket()
+        while not self.paused and sock is not None and getattr(sock, 'pending', lambda: 0)():
+            self.client.loop_read()
+            sock = self.client.socket()
+
+    def write(self):
+        self.client.loop_write()
+
+    def pause(self, event):
+        '''
+        stop reading from the socket until event is set (back pressure,
+        instead of blocking the loop)
+        '''
+        sock = self.client.socket()
+        if sock is None or self.paused:
+            return
+        self.paused = True
+        self.loop.remove_reader(sock.fileno())
+        self.loop.create_task(self.resume(event))
+
+    async def resume(self, event):
+        await event.wait()
+        sock = self.client.socket()
+        if self.paused and sock is not None:
+            self.paused = False
+            self.loop.add_reader(sock.fileno(), self.read)
+            self.read()
+
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+class CommandScheduler(object):
+    '''
+    Priority queue for commands to the Roomba
+    urgent commands (stop, pause, dock) go first, everything else is sent in
+    the order queued (so settings queued before a start are sent before it).
+    A command identical to the last one queued (or sent within dedupe_window
+    seconds) is dropped, unless it is urgent (a repeated stop is always sent),
+    and a command removes queued commands it cancels out (eg stop removes a
+    queued start or dock). The 'future' of a dropped item (if
+    any) is resolved with None.
+    Commands are released at up to rate a second, in bursts of up to burst
+    (rate 0 is unlimited).
+    duplicates and superseded count the commands discarded
+    '''
+    urgent = {'stop', 'pause', 'dock'}
+    supersedes = {'stop':  {'start', 'clean', 'resume', 'pause', 'dock'},
+                  'pause': {'start', 'clean', 'resume'},
+                  'dock':  {'start', 'clean', 'resume', 'pause'}}
+
+    def __init__(self, name=None, rate=2, burst=5, dedupe_window=2):
+        self.name = name or (lambda command: command)  #command name function
+        self.items = []                 #(priority, sequence, item)
+        self.count = itertools.count()
+        self.not_empty = asyncio.Event()
+        self.dedupe_window = dedupe_window
+        self.sent = (None, 0)           #last command released, and when
+        self.duplicates = 0
+        self.superseded = 0
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        self.rate = rate
+        if burst is not None:
+            self.burst = burst
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def priority(self, item):
+        if 'command' in item and self.name(item['command']) in self.urgent:
+            return 0
+        return 1
+
+    def drop(self, item):
+        future = item.get('future')
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    async def put(self, item):
+        self.put_nowait(item)
+
+    def put_nowait(self, item):
+        if 'command' in item:
+            command = item['command']
+            queued = [entry for entry in self.items if 'command' in entry[2]]
+            last, sent_at = self.sent
+            if self.name(command) not in self.urgent and (
+               (queued and queued[-1][2]['command'] == command) or
+               (not queued and last == command and time.monotonic() - sent_at < self.dedupe_window)):
+                self.duplicates += 1
+                LOGGER.info('Duplicate command {} dropped'.format(command))
+                self.drop(item)
+                return
+            cancels = self.supersedes.get(self.name(command), ())
+            kept = [entry for entry in self.items
+                    if not ('command' in entry[2] and self.name(entry[2]['command']) in cancels)]
+        elif 'schedule' in item:
+            kept = [entry for entry in self.items if 'schedule' not in entry[2]]
+        else:
+            kept = self.items
+        if len(kept) != len(self.items):
+            LOGGER.info('{} queued command(s) superseded by {}'.format(len(self.items) - len(kept), item))
+            self.superseded += len(self.items) - len(kept)
+            for entry in self.items:
+                if entry not in kept:
+                    self.drop(entry[2])
+            self.items = kept
+        self.items.append((self.priority(item), next(self.count), item))
+        self.not_empty.set()
+
+    async def get(self):
+        while True:
+            while not self.items:
+                self.not_empty.clear()
+                await self.not_empty.wait()
+            if not self.rate:
+                break
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                break
+            #the highest priority item is picked after the wait
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+        entry = min(self.items)
+        self.items.remove(entry)
+        if 'command' in entry[2]:
+            self.sent = (entry[2]['command'], time.monotonic())
+        return entry[2]
+
+
+class LatencyHistogram(object):
+    '''
+    Rolling histogram of command to effect latency (s), of the last size
+    samples, with buckets upper bounds in seconds
+    '''
+    buckets = (0.5, 1, 2, 5, 10, 30)
+
+    def __init__(self, size=100):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.timeouts = 0
+
+    def add(self, latency):
+        self.samples.append(latency)
+        self.count += 1
+
+    def percentile(self, pcent):
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(int(len(samples) * pcent / 100), len(samples) - 1)]
+
+    def histogram(self):
+        counts = OrderedDict(('<={}s'.format(b), 0) for b in self.buckets)
+        counts['>{}s'.format(self.buckets[-1])] = 0
+        for latency in self.samples:
+            for bucket, limit in zip(counts, self.buckets):
+                if latency <= limit:
+                    counts[bucket] += 1
+                    break
+            else:
+                counts['>{}s'.format(self.buckets[-1])] += 1
+        return counts
+
+    def stats(self):
+        return {'count': self.count,
+                'timeouts': self.timeouts,
+                'median': self.percentile(50),
+                'p90': self.percentile(90),
+                'max': max(self.samples, default=None),
+                'histogram': self.histogram()}
+
+
+class ReconnectPolicy(object):
+    '''
+    Reconnect backoff with a circuit breaker
+    Each consecutive failure multiplies the delay before the next attempt by
+    factor, from initial up to max_interval, less a random fraction (up to
+    jitter) so robots don't retry in step. After threshold consecutive
+    failures the circuit opens: an attempt is only made every max_interval,
+    as a half-open probe, until one succeeds, which closes the circuit and
+    resets the delay.
+    Not thread safe, only use from the event loop (paho callbacks in thread
+    mode use call_soon_threadsafe).
+    '''
+    def __init__(self, initial=1, factor=2, max_interval=300, jitter=0.2, threshold=5, name=''):
+        self.initial = initial
+        self.factor = factor
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.threshold = threshold
+        self.name = name
+        self.half_open = False
+        self.consecutive = 0        #consecutive failures
+        self.attempts = self.failures = self.successes = 0
+        self.disconnects = 0
+        self.opened = 0             #times the circuit has opened
+        self.last_error = None
+        self.last_connected = None
+        self.down_since = None
+        self.downtime = 0           #total time disconnected (s)
+        self.wake = None            #set by reset to end a pending wait
+
+    @property
+    def state(self):
+        if self.consecutive < self.threshold:
+            return 'closed'
+        return 'half-open' if self.half_open else 'open'
+
+    def delay(self):
+        '''
+        seconds to wait before the next attempt
+        '''
+        if self.consecutive == 0:
+            return 0
+        if self.consecutive >= self.threshold:
+            delay = self.max_interval
+        else:
+            delay = min(self.initial * self.factor ** (self.consecutive - 1), self.max_interval)
+        return delay * (1 - self.jitter * random.random())
+
+    async def wait(self):
+        '''
+        wait until the next attempt is allowed, returns True if it is a
+        half-open probe (the circuit is open)
+        '''
+        delay = self.delay()
+        if delay:
+            LOGGER.info('{} reconnect attempt in {:.1f}s ({})'.format(self.name, delay, self.state))
+            self.wake = asyncio.Event()
+            try:
+                await asyncio.wait_for(self.wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.wake = None
+        self.attempts += 1
+        self.half_open = self.consecutive >= self.threshold
+        return self.half_open
+
+    def failure(self, error=None):
+        self.failures += 1
+        self.consecutive += 1
+        self.half_open = False
+        self.last_error = str(error) if error is not None else None
+        if self.down_since is None:
+            self.down_since = time.time()
+        if self.consecutive == self.threshold:
+            self.opened += 1
+            LOGGER.warning('{} failed to connect {} times, retrying every {}s'.format(
+                            self.name, self.consecutive, self.max_interval))
+
+    def success(self):
+        self.successes += 1
+        self.consecutive = 0
+        self.half_open = False
+        self.last_connected = time.time()
+        if self.down_since is not None:
+            self.downtime += self.last_connected - self.down_since
+            self.down_since = None
+
+    def reset(self):
+        '''
+        start again from the initial delay (closes the circuit), and end a
+        pending wait so the next attempt is made now
+        '''
+        self.consecutive = 0
+        self.half_open = False
+        if self.wake is not None:
+            self.wake.set()
+
+    def disconnected(self):
+        if self.down_since is None:
+            self.disconnects += 1
+            self.down_since = time.time()
+
+    def stats(self):
+        '''
+        reconnect metrics
+        '''
+        downtime = self.downtime
+        if self.down_since is not None:
+            downtime += time.time() - self.down_since
+        return {'state': self.state,
+                'attempts': self.attempts,
+                'failures': self.failures,
+                'successes': self.successes,
+                'consecutive_failures': self.consecutive,
+                'disconnects': self.disconnects,
+                'circuit_opened': self.opened,
+                'last_error': self.last_error,
+                'last_connected': self.last_connected,
+                'downtime': round(downtime, 1)}
+
 
 class Roomba(object):
     '''
@@ -292,6 +992,15 @@ class Roomba(object):
 
     VERSION = __version__ = "2.0i"
 
+    # queued messages that only update these keys supersede each other
+    coalesce_keys = {'pose', 'signal'}
+    # paths that must be in master_state for the Roomba to be ready
+    ready_paths = [('state', 'reported', 'cap')]
+    # cleanMissionStatus phases that show a command has taken effect
+    command_phases = {'start': {'run'}, 'clean': {'run'}, 'resume': {'run'},
+                      'pause': {'stop'}, 'stop': {'stop', 'charge'},
+                      'dock': {'hmUsrDock', 'hmPostMsn', 'charge'}}
+
     states = {"charge"          : "Charging",
               "new"             : "New Mission",
               "run"             : "Running",
@@ -428,29 +1137,24 @@ class Roomba(object):
         self.local_mqtt = False
         self.exclude = ""
         self.roomba_connected = False
+        self.transport = 'thread'           #'thread' runs MQTT i/o in paho threads, 'asyncio' in the event loop
+        self.client_helper = None           #AsyncioHelper for client
+        self.connect_task = None
+        self.tls_generation = 'default'     #robot generation for tls_context (see tls_generation)
+        self.tls = None                     #TLSSession for client
+        self.reconnect_policy = ReconnectPolicy(name=roombaName)
+        self.broker_policy = ReconnectPolicy(name='{} broker'.format(roombaName))
+        self.broker_task = None
+        self.connect_timeout = 5            #seconds to wait for MQTT on_connect
         self.indent = 0
         self.master_indent = 0
         self.raw = False
-        self.drawmap = False
-        self.mapSize = None
-        self.roomba_angle = 0
-        self.old_x_y = None
-        self.fnt = None
-        self.home_pos = None
-        self.angle = 0
-        self.invert_x = self.invert_y = None    #mirror x,y
+        self.init_map(LOGGER)
         self.current_state = None
         self.simulation = False
         self.simulation_reset = False
-        self.max_distance = 500             #max distance to draw lines
-        self.icons = icons(base_icon=None, angle=self.angle, fnt=self.fnt, size=(32,32), log=LOGGER)
-        self.base = None                    #base map
-        self.room_outline_contour = None
-        self.room_outline = None
-        self.floorplan = None
-        self.floorplan_size = None
-        self.previous_display_text = self.display_text = None
         self.master_state = {}
+        self.state_index = {}               #key -> {path: value} index of master_state
         self.update_seconds = 300           #update with all values every 5 minutes
         self.show_final_map = True
         self.client = None                  #Roomba MQTT client
@@ -459,11 +1163,24 @@ class Roomba(object):
         self.timers = {}
         self.flags = {}
         self.max_sqft = None
+        self.percent_max_sqft = None        #max_sqft of the last percent complete
         self.cb = None
+        self.cb_delta = False
+        self.listeners = []                 #(keys, callback) change listeners
+        self.decode_inline = True           #decode in the event loop, draw maps in map_executor
+        self.map_executor = None            #single map drawing worker (thread or process)
+        self.map_submitted = 0              #frames submitted to the map worker process
+        self.map_process = False            #draw maps in a worker process
+        self.map_options = {}               #enable_map options (for worker process)
         
         self.is_connected = asyncio.Event()
-        self.q = asyncio.Queue()
-        self.command_q = asyncio.Queue()            
+        self.ready = self.loop.create_future()  #set when ready_paths are received
+        self.q = MessageQueue(key=self.message_key)
+        self.command_q = CommandScheduler(name=self.command_name)
+        self.preferences = {}               #preference settings waiting to be sent
+        self.command_timeout = 30           #seconds to wait for a command to take effect
+        self.effect_waiters = []            #(check, future, kind, start) of commands in progress
+        self.latency = {}                   #kind: LatencyHistogram of command to effect latency
         self.loop.create_task(self.process_q())
         self.loop.create_task(self.process_command_q())
         self.update = self.loop.create_task(self.periodic_update())
@@ -480,10 +1197,79 @@ class Roomba(object):
         if self.webport:
             self.setup_webserver()
             
+    def init_map(self, log=None):
+        '''
+        Initialize map drawing attributes
+        '''
+        self.drawmap = False
+        self.mapSize = None
+        self.roomba_angle = 0
+        self.old_x_y = None
+        self.fnt = None
+        self.home_pos = None
+        self.angle = 0
+        self.invert_x = self.invert_y = None    #mirror x,y
+        self.roomba_size = (32,32)          #roomba icon size
+        self.max_distance = 500             #max distance to draw lines
+        self.icons = icons(base_icon=None, angle=self.angle, fnt=self.fnt, size=(32,32), log=log if log else LOGGER)
+        self.base = None                    #base map
+        self.room_outline_contour = None
+        self.room_outline = None
+        self.outline_box = None             #bounding box of the PIL room outline
+        self.floorplan = None
+        self.floorplan_size = None
+        self.static_layer = None            #floorplan and room outline pre-merged
+        self.static_layers = None           #(floorplan, room outline) static_layer was made from
+        self.composite = None               #last composited map (before rotation)
+        self.composite_layers = ()          #(base, problems, static_layer) composite was made from
+        self.sprite_box = None              #roomba sprite box in composite
+        self.map_generation = 0             #incremented when the map changes
+        self.previous_map_generation = None #map_generation last saved
+        self.map_signature = None           #last frame drawn (co-ordinates, flags)
+        self.map_writer = None              #background map image writer
+        self.frames = FrameStore()          #latest encoded images, served by web_server
+        self.max_fps = 1.0                  #max map images written per second
+        self.previous_display_text = self.display_text = None
+
     def setup_webserver(self):
         from web_server import webserver
         self.ws = webserver(roomba=self, webport=self.webport)
                                    
+    def check_ready(self):
+        '''
+        set ready if all ready_paths are in master_state
+        '''
+        if not self.ready.done() and all(path in self.state_index.get(path[-1], {})
+                                         for path in self.ready_paths):
+            LOGGER.info('{} ready'.format(self.roombaName))
+            self.ready.set_result(True)
+
+    async def wait_ready(self, timeout=None):
+        '''
+        wait for the Roomba to report ready_paths (capabilities etc) with
+        timeout (None is no timeout).
+        returns True if ready, False on timeout
+        '''
+        try:
+            await asyncio.wait_for(asyncio.shield(self.ready), timeout)
+        except asyncio.TimeoutError:
+            LOGGER.warning('{} not ready after {}s'.format(self.roombaName, timeout))
+        return self.ready.done()
+
+    async def probe(self, timeout=5):
+        '''
+        Check the robot is reachable (tcp connect, no TLS) without tying up an
+        executor thread in a blocking client.connect
+        '''
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.address, self.roomba_port), timeout)
+            writer.close()
+            return True
+        except (asyncio.TimeoutError, OSError) as e:
+            LOGGER.debug('{} not reachable at {}: {}'.format(self.roombaName, self.address, e))
+            return False
+
     async def event_wait(self, evt, timeout):
         '''
         Event.wait() with timeout
@@ -525,22 +1311,17 @@ class Roomba(object):
             self.client.on_publish = self.on_publish
             self.client.on_subscribe = self.on_subscribe
             self.client.on_disconnect = self.on_disconnect
+            if self.transport == 'asyncio':
+                self.client_helper = AsyncioHelper(self.loop, self.client)
 
             # Uncomment to enable debug messages
             #self.client.on_log = self.on_log
 
             LOGGER.info("Setting TLS")
             try:
-                #self.client._ssl_context = None
-                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-                context.check_hostname = False
-                context.verify_mode = ssl.CERT_NONE
-                context.options |= 0x4
-                # Either of the following context settings works - choose one
-                # Needed for 980 and earlier robots as their security level is 1.
-                context.set_ciphers('HIGH:!DH:!aNULL')
-                #context.set_ciphers('DEFAULT@SECLEVEL=1')
-                self.client.tls_set_context(context)
+                #shared context, with this robot's session for resumption
+                self.tls = TLSSession(tls_context(self.tls_generation), self.roombaName)
+                self.client.tls_set_context(self.tls)
             except Exception as e:
                 LOGGER.exception("Error setting TLS: {}".format(e))
 
@@ -553,9 +1334,11 @@ class Roomba(object):
 
     def connect(self):
         '''
-        just create async_connect task
+        just create async_connect task (if one isn't already running)
         '''
-        return self.loop.create_task(self.async_connect())
+        if self.connect_task is None or self.connect_task.done():
+            self.connect_task = self.loop.create_task(self.async_connect())
+        return self.connect_task
 
     async def async_connect(self):
         '''
@@ -565,21 +1348,29 @@ class Roomba(object):
             LOGGER.critical("Invalid address, blid, or password! All these "
                               "must be specified!")
             return False
-        count = 0
-        max_retries = 3
-        retry_timeout = 1
+        policy = self.reconnect_policy
         while not self.roomba_connected:
             try:
+                if await policy.wait() and not await self.probe():
+                    policy.failure('{} unreachable'.format(self.address))
+                    continue
+                if self.roomba_connected:   #connected while we waited
+                    break
                 if self.client is None:
                     LOGGER.info("Connecting...")
                     self.setup_client()
                     await self.loop.run_in_executor(None, self.client.connect, self.address, self.roomba_port, 60)
                 else:
                     LOGGER.info("Attempting to Reconnect...")
-                    self.client.loop_stop()
+                    if self.transport == 'thread':
+                        #joins the paho thread (stopped by on_disconnect)
+                        await self.loop.run_in_executor(None, self.client.loop_stop)
                     await self.loop.run_in_executor(None, self.client.reconnect)
-                self.client.loop_start()
-                await self.event_wait(self.is_connected, 1)    #wait for MQTT on_connect to fire (timeout 1 second)
+                if self.transport == 'thread':
+                    self.client.loop_start()
+                #wait for MQTT on_connect to fire
+                if not await self.event_wait(self.is_connected, self.connect_timeout) or not self.roomba_connected:
+                    policy.failure('no MQTT connection')
             except (ConnectionRefusedError, OSError) as e:
                 if e.errno == 111:      #errno.ECONNREFUSED
                     LOGGER.error('Unable to Connect to roomba {}, make sure nothing else is connected (app?), '
@@ -588,25 +1379,18 @@ class Roomba(object):
                     LOGGER.error('Unable to contact roomba {} on ip {}'.format(self.roombaName, self.address))
                 else:
                     LOGGER.error("Connection Error: {} ".format(e))
-                
-                await asyncio.sleep(retry_timeout)
-                LOGGER.error("Attempting retry Connection# {}".format(count))
-                
-                count += 1
-                if count >= max_retries:
-                    retry_timeout = 60
-                    
+                policy.failure(e)
             except asyncio.CancelledError:
                 LOGGER.error('Connection Cancelled')
                 break
             except Exception as e:
-                #LOGGER.error("Error: {} ".format(e))
                 LOGGER.exception(e)
-                if count >= max_retries:
-                    break
+                policy.failure(e)
             
         if not self.roomba_connected:   
             LOGGER.error("Unable to connect to {}".format(self.roombaName))
+        else:
+            LOGGER.info('{} connected, reconnect stats: {}'.format(self.roombaName, policy.stats()))
         return self.roomba_connected
 
     def disconnect(self):
@@ -616,23 +1400,52 @@ class Roomba(object):
             self.loop.create_task(self._disconnect())
     
     async def _disconnect(self):
-        #if self.ws:
-        #    await self.ws.cancel()
+        if self.ws:
+            self.ws.close()
         tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
         [task.cancel() for task in tasks]
         LOGGER.info("Cancelling {} outstanding tasks".format(len(tasks)))
         await asyncio.gather(*tasks, return_exceptions=True)
+        if self.map_executor is not None:
+            self.map_executor.shutdown(wait=False)
         self.client.disconnect()
         if self.local_mqtt:
-            self.mqttc.loop_stop()
+            if self.transport == 'thread':
+                self.mqttc.loop_stop()
+            else:
+                self.mqttc.disconnect()
         LOGGER.info('{} disconnected'.format(self.roombaName))
         
+    def set_address(self, address):
+        '''
+        Robot has moved to a new ip address (DHCP), the next (re)connect
+        attempt goes to the new address straight away (resets the reconnect
+        backoff), nothing else is torn down
+        '''
+        if address == self.address:
+            return
+        LOGGER.info('{} address changed from {} to {}'.format(self.roombaName, self.address, address))
+        if self.address in self.roombas_config:
+            self.roombas_config[address] = self.roombas_config.pop(self.address)
+        self.address = address
+        if self.client is not None:
+            # only sets host, async_connect reconnects to it
+            self.client.connect_async(self.address, self.roomba_port, 60)
+        self.loop.call_soon_threadsafe(self.reconnect_policy.reset)
+
     def connected(self, state):
         self.roomba_connected = state
+        if state:
+            self.loop.call_soon_threadsafe(self.reconnect_policy.success)
+        else:
+            self.loop.call_soon_threadsafe(self.reconnect_policy.disconnected)
         self.publish('status', 'Online' if self.roomba_connected else 'Offline at {}'.format(time.ctime()))
+        self.loop.call_soon_threadsafe(self.notify_listeners, {'roomba_connected'})
         
     def on_connect(self, client, userdata, flags, rc):
         LOGGER.info("Roomba Connected")
+        if self.tls is not None:
+            self.tls.update(client.socket())
         if rc == 0:
             self.connected(True)
             self.client.subscribe(self.topic)
@@ -654,7 +1467,38 @@ class Roomba(object):
             self.master_indent = max(self.master_indent, len(msg.topic))
             
         if not self.simulation:
-            asyncio.run_coroutine_threadsafe(self.q.put(msg), self.loop)
+            #decoded once here, the queue keys on it and process_q uses it
+            item = (msg, self.parse_payload(msg.payload))
+            if self.client_helper is not None:
+                #in the event loop, which must not block
+                if self.q.policy == 'block' and self.q.full():
+                    #stop reading from the robot until there is room in the queue
+                    self.q.not_full.clear()
+                    self.loop.create_task(self.q.put(item))
+                    self.client_helper.pause(self.q.not_full)
+                else:
+                    self.q.put_nowait(item)
+                return
+            fut = asyncio.run_coroutine_threadsafe(self.q.put(item), self.loop)
+            if self.q.policy == 'block':
+                try:
+                    fut.result()    #wait for room in the queue
+                except Exception as e:
+                    LOGGER.warning('Message not queued: {}'.format(e))
+
+    def message_key(self, item):
+        '''
+        key used to coalesce queued (msg, decoded payload) items, messages on
+        the same topic updating the same set of keys (all in coalesce_keys)
+        supersede each other, None if msg should not be coalesced
+        '''
+        msg, data = item
+        if not isinstance(data, dict):
+            return None
+        paths = self.leaf_paths(data)
+        if not paths or any(self.coalesce_keys.isdisjoint(path) for path in paths):
+            return None
+        return (msg.topic, frozenset(paths))
             
     async def process_q(self):
         '''
@@ -663,15 +1507,20 @@ class Roomba(object):
         while True:
             try:
                 if self.q.qsize() > 0:
-                    LOGGER.warning('Pending event queue size is: {}'.format(self.q.qsize()))
-                msg = await self.q.get()
+                    LOGGER.warning('Pending event queue size is: {}, dropped: {}, coalesced: {}'.format(
+                                     self.q.qsize(), self.q.dropped, self.q.coalesced))
+                msg, data = await self.q.get()
                 
                 if not self.command_q.empty():
                     LOGGER.info('Command waiting in queue')
-                    await asyncio.sleep(1)
+                    await asyncio.sleep(0)  #let the command go first
                     
-                log_string, json_data = self.decode_payload(msg.topic,msg.payload)
-                self.dict_merge(self.master_state, json_data)
+                log_string, json_data = self.decode_payload(msg.topic,msg.payload,data)
+                changed = self.dict_merge(self.master_state, json_data, ())
+                if changed:
+                    self.check_ready()
+                    self.check_effects()
+                    self.notify_listeners(self.changed_keys(changed))
 
                 if self.pretty_print:
                     LOGGER.info("%-{:d}s : %s".format(self.master_indent) % (msg.topic, log_string))
@@ -680,10 +1529,10 @@ class Roomba(object):
 
                 if self.raw:
                     self.publish(msg.topic, msg.payload)
+                elif self.decode_inline:
+                    self.decode_topics(json_data, None, changed)
                 else:
-                    await self.loop.run_in_executor(None, self.decode_topics, json_data)
-                    
-                self.q.task_done()
+                    await self.loop.run_in_executor(None, self.decode_topics, json_data, None, changed)
                 
             except asyncio.CancelledError:
                 break
@@ -699,7 +1548,10 @@ class Roomba(object):
             await asyncio.sleep(self.update_seconds)
             if self.roomba_connected:
                 LOGGER.info("Publishing master_state")
-                await self.loop.run_in_executor(None, self.decode_topics, self.master_state)
+                if self.decode_inline:
+                    self.decode_topics(self.master_state)
+                else:
+                    await self.loop.run_in_executor(None, self.decode_topics, self.master_state)
 
     def on_publish(self, mosq, obj, mid):
         pass
@@ -712,6 +1564,10 @@ class Roomba(object):
         self.connected(False)
         if rc != 0:
             LOGGER.warning("Unexpected Disconnect! - reconnecting")
+            if self.transport == 'thread':
+                #stop paho's own reconnect, async_connect uses reconnect_policy
+                self.client.loop_stop()
+            self.loop.call_soon_threadsafe(self.connect)
         else:
             LOGGER.info("Disconnected")
 
@@ -760,13 +1616,16 @@ class Roomba(object):
             self.mqttc.on_message = self.broker_on_message
             self.mqttc.on_connect = self.broker_on_connect
             self.mqttc.on_disconnect = self.broker_on_disconnect
+            if self.transport == 'asyncio':
+                AsyncioHelper(self.loop, self.mqttc)
             if user and passwd:
                 self.mqttc.username_pw_set(user, passwd)
             self.mqttc.connect(broker, port, 60)
             self.brokerFeedback = self.set_mqtt_topic(brokerFeedback)
             self.brokerCommand = self.set_mqtt_topic(brokerCommand, True)
             self.brokerSetting = self.set_mqtt_topic(brokerSetting, True)
-            self.mqttc.loop_start()
+            if self.transport == 'thread':
+                self.mqttc.loop_start()
             self.local_mqtt = True
         except socket.error:
             LOGGER.error("Unable to connect to MQTT Broker")
@@ -792,7 +1651,11 @@ class Roomba(object):
         elif "setting" in msg.topic:
             LOGGER.info("Received SETTING: {}".format(payload))
             cmd = str(payload).split()
-            self.set_preference(cmd[0], cmd[1])
+            #"preference setting [preference setting...]" sent as one delta
+            if not cmd or len(cmd) % 2:
+                LOGGER.warning('SETTING ignored, expected preference setting pairs: {}'.format(payload))
+                return
+            self.set_preferences(dict(zip(cmd[::2], cmd[1::2])))
         elif "json" in msg.topic:
             LOGGER.info("Received JSON: {}".format(payload))
             try:
@@ -806,7 +1669,7 @@ class Roomba(object):
         elif 'simulate' in msg.topic:
             LOGGER.info('received simulate command: {}'.format(payload))
             self.set_simulate(True)
-            asyncio.run_coroutine_threadsafe(self.q.put(msg), self.loop)
+            asyncio.run_coroutine_threadsafe(self.q.put((msg, self.parse_payload(msg.payload))), self.loop)
         else:
             LOGGER.warn("Unknown topic: {}".format(str(msg.topic)))
             
@@ -821,21 +1684,147 @@ class Roomba(object):
 
     def broker_on_disconnect(self, mosq, obj, rc):
         LOGGER.debug("Broker disconnected")
+        if rc != 0:
+            if self.transport == 'thread':
+                #stop paho's own reconnect, reconnect_broker uses broker_policy
+                self.mqttc.loop_stop()
+            self.loop.call_soon_threadsafe(self.broker_policy.disconnected)
+            self.loop.call_soon_threadsafe(self.reconnect_broker)
+            
+    def reconnect_broker(self):
+        '''
+        just create async_reconnect_broker task (if one isn't already running)
+        '''
+        if self.broker_task is None or self.broker_task.done():
+            self.broker_task = self.loop.create_task(self.async_reconnect_broker())
+        return self.broker_task
+            
+    async def async_reconnect_broker(self):
+        policy = self.broker_policy
+        while self.mqttc is not None:
+            await policy.wait()
+            try:
+                if self.transport == 'thread':
+                    #joins the paho thread (stopped by broker_on_disconnect)
+                    await self.loop.run_in_executor(None, self.mqttc.loop_stop)
+                await self.loop.run_in_executor(None, self.mqttc.reconnect)
+                if self.transport == 'thread':
+                    self.mqttc.loop_start()
+                policy.success()
+                return
+            except (OSError, ValueError) as e:
+                policy.failure(e)
+        
+    async def async_send_command(self, command, timeout=None):
+        '''
+        queue command, returns True when the reported state shows it has taken
+        effect (see command_phases), False if not within timeout (default
+        command_timeout), or None if the command has no known effect, or was
+        dropped as a duplicate or superseded before it was sent. Raises the
+        error if it could not be sent
+        '''
+        name = self.command_name(command)
+        phases = self.command_phases.get(name)
+        check = (lambda: self.phase in phases) if phases else None
+        waiter = self.expect_effect(check, name)
+        await self.command_q.put({'command':command, 'future':waiter})
+        return await self.wait_effect(waiter, name, timeout)
+        
+    async def async_set_preference(self, preference, setting, timeout=None):
+        return await self.async_set_preferences({preference: setting}, timeout)
+        
+    async def async_set_preferences(self, settings, timeout=None):
+        '''
+        queue settings {preference: setting} to be published in one delta,
+        settings queued before the delta is sent are merged into it, so a
+        preference set again before then only sends the latest setting.
+        returns True when the robot reports the new settings, False if not
+        within timeout (default command_timeout). Raises the error if they
+        could not be sent
+        '''
+        values = {preference: self.preference_value(setting) for preference, setting in settings.items()}
+        waiter = self.expect_effect(
+            lambda: all(self.lookup_index(k) == v for k, v in values.items()), 'preference')
+        queued = bool(self.preferences)
+        self.preferences.update(settings)
+        if not queued:
+            await self.command_q.put({'preferences': True})
+        return await self.wait_effect(waiter, 'preference', timeout)
+        
+    def expect_effect(self, check, kind):
+        '''
+        returns a future resolved by check_effects when check() is True, None
+        if there is no check
+        '''
+        if check is None:
+            return None
+        future = self.loop.create_future()
+        if check():     #already in effect
+            future.set_result(True)
+        else:
+            self.effect_waiters.append((check, future, kind, time.time()))
+        return future
+        
+    def check_effects(self):
+        '''
+        resolve commands whose effect is now in the reported state
+        '''
+        for waiter in list(self.effect_waiters):
+            check, future, kind, start = waiter
+            if not future.done() and check():
+                latency = time.time() - start
+                self.latency.setdefault(kind, LatencyHistogram()).add(latency)
+                LOGGER.debug('{} {} took effect in {:.2f}s'.format(self.roombaName, kind, latency))
+                future.set_result(True)
+            if future.done():
+                self.effect_waiters.remove(waiter)
+                
+    async def wait_effect(self, future, kind, timeout=None):
+        if future is None:
+            return None
+        timeout = self.command_timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            self.latency.setdefault(kind, LatencyHistogram()).timeouts += 1
+            LOGGER.warning('{} {} not done after {}s'.format(self.roombaName, kind, timeout))
+            future.cancel()
+            self.effect_waiters = [w for w in self.effect_waiters if w[1] is not future]
+            return False
+            
+    def latency_stats(self):
+        '''
+        command to effect latency stats, by command (or 'preference')
+        '''
+        return {kind: histogram.stats() for kind, histogram in self.latency.items()}
         
-    async def async_send_command(self, command):
-        await self.command_q.put({'command':command})
-        
-    async def async_set_preference(self, preference, setting):
-        await self.command_q.put({'setting':(preference, setting)})
+    def command_name(self, command):
+        if isinstance(command, dict):
+            return command.get('command')
+        try:
+            return json.loads(command).get('command')
+        except (ValueError, AttributeError):
+            return command
+            
+    def preference_value(self, setting):
+        if isinstance(setting, bool):
+            return setting
+        return setting.lower() == "true"
         
     async def async_set_cleanSchedule(self, setting):
         await self.command_q.put({'schedule':setting})
                     
-    def send_command(self, command):
-        asyncio.run_coroutine_threadsafe(self.command_q.put({'command':command}), self.loop)
+    def send_command(self, command, timeout=None):
+        '''
+        returns a concurrent.futures.Future of async_send_command
+        '''
+        return asyncio.run_coroutine_threadsafe(self.async_send_command(command, timeout), self.loop)
+        
+    def set_preference(self, preference, setting, timeout=None):
+        return self.set_preferences({preference: setting}, timeout)
         
-    def set_preference(self, preference, setting):
-        asyncio.run_coroutine_threadsafe(self.command_q.put({'setting':(preference, setting)}), self.loop)
+    def set_preferences(self, settings, timeout=None):
+        return asyncio.run_coroutine_threadsafe(self.async_set_preferences(settings, timeout), self.loop)
         
     def set_cleanSchedule(self, setting):
         asyncio.run_coroutine_threadsafe(self.command_q.put({'schedule':setting}), self.loop)
@@ -843,19 +1832,38 @@ class Roomba(object):
     async def process_command_q(self):
         '''
         Command processing loop, run until program exit
+        an item that can't be sent is logged, and whatever is waiting for its
+        effect gets the exception
         '''
         while True:
             value = await self.command_q.get()
             command = value.get('command')
-            setting = value.get('setting')
             schedule = value.get('schedule')
-            if command:
-                await self.loop.run_in_executor(None, self._send_command, command)
-            if setting:
-                await self.loop.run_in_executor(None, self._set_preference, *setting)
-            if schedule:
-                await self.loop.run_in_executor(None, self._set_cleanSchedule, schedule)
-            self.command_q.task_done()
+            try:
+                if command:
+                    await self.run_client(self._send_command, command)
+                if value.get('preferences'):
+                    settings, self.preferences = self.preferences, {}
+                    await self.run_client(self._set_preferences, settings)
+                if schedule:
+                    await self.run_client(self._set_cleanSchedule, schedule)
+            except Exception as e:
+                LOGGER.error('{} unable to send {}: {}'.format(self.roombaName, value, e))
+                waiters = [value.get('future')]
+                if value.get('preferences'):
+                    waiters += [waiter[1] for waiter in self.effect_waiters if waiter[2] == 'preference']
+                for future in waiters:
+                    if future is not None and not future.done():
+                        future.set_exception(e)
+                
+    async def run_client(self, func, *args):
+        '''
+        run func (which publishes to the Roomba), in the loop with the asyncio
+        transport (publish doesn't block), else in the default executor
+        '''
+        if self.transport == 'asyncio':
+            return func(*args)
+        return await self.loop.run_in_executor(None, func, *args)
 
     def _send_command(self, command):
         '''
@@ -938,14 +1946,12 @@ class Roomba(object):
         self._send_command(myCommand)
 
     def _set_preference(self, preference, setting):
-        LOGGER.info("Received SETTING: {}, {}".format(preference, setting))
-        if isinstance(setting, bool):
-            val = setting
-        elif setting.lower() == "true":
-            val = True
-        else:
-            val = False
-        Command = {"state": {preference: val}}
+        self._set_preferences({preference: setting})
+        
+    def _set_preferences(self, settings):
+        LOGGER.info("Received SETTINGS: {}".format(settings))
+        state = {preference: self.preference_value(setting) for preference, setting in settings.items()}
+        Command = {"state": state}
         myCommand = json.dumps(Command)
         LOGGER.info("Publishing Roomba {} Setting :{}".format(self.roombaName, myCommand))
         self.client.publish("delta", myCommand)
@@ -966,9 +1972,35 @@ class Roomba(object):
             LOGGER.debug("Publishing item: {}: {}".format(topic, message))
             self.mqttc.publish(topic, message)
             
-    def set_callback(self, cb=None):
+    def set_callback(self, cb=None, delta=False):
+        '''
+        cb is called with master_state after every update, if delta is True
+        it is called as cb(master_state, changed) where changed is the set of
+        key paths changed by the update (None for a full periodic update)
+        '''
         self.cb = cb
+        self.cb_delta = delta
         
+    def add_listener(self, cb, keys=None):
+        '''
+        call cb(keys) in the event loop whenever master_state changes, keys is
+        the set of keys (at any level) that changed, plus 'roomba_connected'
+        when the connection state changes. If keys is given here, cb is only
+        called when one of them has changed.
+        '''
+        self.listeners.append((None if keys is None else set(keys), cb))
+
+    def remove_listener(self, cb):
+        self.listeners = [(keys, l_cb) for keys, l_cb in self.listeners if l_cb != cb]
+
+    def notify_listeners(self, keys):
+        for watch, cb in self.listeners:
+            if watch is None or not watch.isdisjoint(keys):
+                try:
+                    cb(keys)
+                except Exception as e:
+                    LOGGER.exception(e)
+
     def get_colour(self, colour, default=(64,64,64,255)):
         try:
             if isinstance(colour, str):
@@ -984,11 +2016,29 @@ class Roomba(object):
             colour = default
         return colour
             
-    def set_options(self, raw=False, indent=0, pretty_print=False, max_sqft=0):
+    def set_options(self, raw=False, indent=0, pretty_print=False, max_sqft=0,
+                          queue_size=None, queue_policy=None, decode_inline=None,
+                          transport=None):
+        '''
+        decode_inline True decodes messages and runs the state machine in the
+        event loop, with only map drawing in a dedicated worker thread. False
+        decodes each message in the default executor (as before).
+        transport 'thread' (the default) uses a paho network thread per client,
+        'asyncio' runs MQTT network i/o in the event loop (one thread for all
+        Roombas), the blocking connect/reconnect (and TLS handshake) still run
+        in the default executor. Set it before connecting.
+        '''
         self.raw = raw
         self.indent = indent
         self.pretty_print = pretty_print
         self.max_sqft = int(max_sqft)
+        self.q.configure(queue_size, queue_policy)
+        if decode_inline is not None:
+            self.decode_inline = decode_inline
+        if transport is not None:
+            if transport not in ('asyncio', 'thread'):
+                raise ValueError("transport must be 'asyncio' or 'thread'")
+            self.transport = transport
         if self.raw:
             LOGGER.info("Posting RAW data")
         else:
@@ -1008,8 +2058,27 @@ class Roomba(object):
                    bin_full_file="binfull.png",
                    tank_low_file="tanklow.png",
                    floorplan = None,
-                   roomba_size=(50,50), draw_edges = 30, auto_rotate=False):
+                   roomba_size=(50,50), draw_edges = 30, auto_rotate=False,
+                   map_process=False, sprite_buckets=360, max_fps=1.0):
         #returns an awaitable future
+        #map_process True draws maps in a separate worker process, so map
+        #drawing does not compete with message handling for the GIL
+        self.map_options = {'enable': enable, 'mapSize': mapSize, 'mapPath': mapPath,
+                            'iconPath': iconPath, 'roomOutline': roomOutline,
+                            'enableMapWithText': enableMapWithText, 'fillColor': fillColor,
+                            'outlineColor': outlineColor, 'outlineWidth': outlineWidth,
+                            'home_icon_file': home_icon_file, 'roomba_icon_file': roomba_icon_file,
+                            'roomba_error_file': roomba_error_file,
+                            'roomba_cancelled_file': roomba_cancelled_file,
+                            'roomba_battery_file': roomba_battery_file,
+                            'bin_full_file': bin_full_file, 'tank_low_file': tank_low_file,
+                            'floorplan': floorplan, 'roomba_size': roomba_size,
+                            'draw_edges': draw_edges, 'auto_rotate': auto_rotate,
+                            'sprite_buckets': sprite_buckets, 'max_fps': max_fps}
+        if map_process != self.map_process and self.map_executor is not None:
+            self.map_executor.shutdown(wait=False)
+            self.map_executor = None
+        self.map_process = map_process
         
         return self.loop.run_in_executor(None,  self._enable_map, enable,
                                                 mapSize, mapPath, iconPath, roomOutline,
@@ -1017,7 +2086,7 @@ class Roomba(object):
                                                 home_icon_file, roomba_icon_file, roomba_error_file,
                                                 roomba_cancelled_file, roomba_battery_file,
                                                 bin_full_file, tank_low_file, floorplan, roomba_size, draw_edges,
-                                                auto_rotate)
+                                                auto_rotate, sprite_buckets, max_fps, not map_process)
 
     def _enable_map(self, enable=False, mapSize="(800,1500,0,0,0,0)",
                    mapPath=".", iconPath = "./", roomOutline=True,
@@ -1033,7 +2102,8 @@ class Roomba(object):
                    bin_full_file="binfull.png",
                    tank_low_file="tanklow.png",
                    floorplan = None,
-                   roomba_size=(50,50), draw_edges = 30, auto_rotate=False):
+                   roomba_size=(50,50), draw_edges = 30, auto_rotate=False,
+                   sprite_buckets=360, max_fps=1.0, images=True):
         '''
         Enable live map drawing. mapSize is x,y size, x,y offset of docking
         station ((0,0) is the center of the image) final value is map rotation
@@ -1049,7 +2119,11 @@ class Roomba(object):
         less CPU intensive). roomOutline enables the previous largest saved
         outline to be overlayed on the map (so you can see where cleaning was
         missed). This is on by default, but the alignment doesn't work so well,
-        so you can turn it off.
+        so you can turn it off. sprite_buckets is the number of angles the
+        rotated roomba icon is cached at (360 = 1 degree steps). max_fps is the
+        maximum number of map images written per second (0 for no limit).
+        images False only sets up what make_frame needs, as the map is drawn
+        (and the images kept) by a map worker process (map_process).
         Returns map enabled True/False
         '''
         if not HAVE_PIL: #can't draw a map without PIL!
@@ -1081,6 +2155,15 @@ class Roomba(object):
             if len(self.mapSize) >=8:
                 self.invert_y = self.mapSize[7]
             self.mapPath = mapPath
+            self.roomba_size = tuple(roomba_size) if roomba_size else self.icons.size
+            if not images:
+                #drop any images from drawing the map here before
+                self.base = self.roomba_problem = self.map_no_text = None
+                self.floorplan = self.room_outline = self.room_outline_contour = None
+                self.static_layer = self.static_layers = self.composite = None
+                self.composite_layers = ()
+                self.drawmap = enable
+                return True
             # get a font
             if self.fnt is None:
                 try:
@@ -1091,6 +2174,10 @@ class Roomba(object):
             #load icons
             self.icons.set_font(self.fnt)
             self.icons.set_angle(self.angle)
+            self.icons.set_buckets(sprite_buckets)
+            self.max_fps = max_fps
+            if self.map_writer is not None:
+                self.map_writer.set_max_fps(max_fps)
 
             self.icons.load_icon_file('roomba', os.path.join(iconPath, roomba_icon_file), roomba_size)
             self.icons.load_icon_file('stuck', os.path.join(iconPath, roomba_error_file), roomba_size)
@@ -1149,7 +2236,7 @@ class Roomba(object):
         td = dt - datetime.datetime(1970, 1, 1)
         return int(td.total_seconds())
 
-    def dict_merge(self, dct, merge_dct):
+    def dict_merge(self, dct, merge_dct, path=None, changed=None):
         '''
         Recursive dict merge. Inspired by :meth:``dict.update()``, instead
         of updating only top-level keys, dict_merge recurses down into dicts
@@ -1157,15 +2244,92 @@ class Roomba(object):
         merged into ``dct``.
         :param dct: dict onto which the merge is executed
         :param merge_dct: dct merged into dct
-        :return: None
-        '''
+        :param path: key path of dct in master_state (() for master_state
+                     itself), if given state_index is kept up to date
+        :param changed: set to add changed paths to (used when recursing)
+        :return: set of key paths (tuples) whose value was added, changed or
+                 removed (replacing a dict removes its leaves)
+        '''
+        if changed is None:
+            changed = set()
+        prefix = () if path is None else path
         for k, v in merge_dct.items():
             if (k in dct and isinstance(dct[k], dict)
                     and isinstance(merge_dct[k], Mapping)):
-                self.dict_merge(dct[k], merge_dct[k])
+                self.dict_merge(dct[k], merge_dct[k],
+                                None if path is None else path + (k,),
+                                changed)
             else:
+                if k not in dct or dct[k] != v:
+                    changed.add(prefix + (k,))
+                    if isinstance(v, dict):
+                        self.leaf_paths(v, prefix + (k,), changed)
+                    if isinstance(dct.get(k), dict):    #removed leaves
+                        self.leaf_paths(dct[k], prefix + (k,), changed)
+                if path is not None:
+                    if isinstance(dct.get(k), dict):
+                        self.unindex_state(path + (k,), dct[k])
+                    self.index_state(path + (k,), v)
                 dct[k] = merge_dct[k]
-                
+        return changed
+
+    def leaf_paths(self, dct, path=(), paths=None):
+        '''
+        return set of paths to every leaf (non dict) value in dct
+        '''
+        if paths is None:
+            paths = set()
+        for k, v in dct.items():
+            if isinstance(v, dict):
+                self.leaf_paths(v, path + (k,), paths)
+            else:
+                paths.add(path + (k,))
+        return paths
+
+    def changed_keys(self, changed):
+        '''
+        return set of every key (at any level) in the changed paths,
+        so 'pose' is included if ('state', 'reported', 'pose', 'theta') changed
+        '''
+        return {k for path in changed for k in path}
+
+    def index_state(self, path, value):
+        '''
+        add value (and everything below it if it's a dict) to state_index,
+        state_index is {key: {path: value}} so that properties can be looked
+        up without walking master_state
+        '''
+        self.state_index.setdefault(path[-1], {})[path] = value
+        if isinstance(value, dict):
+            for k, v in value.items():
+                self.index_state(path + (k,), v)
+
+    def unindex_state(self, path, value):
+        '''
+        remove value (and everything below it if it's a dict) from state_index
+        '''
+        if isinstance(value, dict):
+            for k, v in value.items():
+                self.unindex_state(path + (k,), v)
+        paths = self.state_index.get(path[-1])
+        if paths is not None:
+            paths.pop(path, None)
+            if not paths:
+                del self.state_index[path[-1]]
+
+    def set_state(self, path, value):
+        '''
+        replace the value at path in master_state, keeping state_index in step.
+        the parent of path must already exist
+        '''
+        parent = self.master_state
+        for k in path[:-1]:
+            parent = parent[k]
+        if path[-1] in parent:
+            self.unindex_state(path, parent[path[-1]])
+        parent[path[-1]] = value
+        self.index_state(path, value)
+
     def recursive_lookup(self, search_dict, key, cap=False):
         '''
         recursive dictionary lookup
@@ -1186,7 +2350,7 @@ class Roomba(object):
         
     def is_setting(self, setting, search_dict=None):
         if search_dict is None:
-            search_dict = self.master_state
+            return setting in self.state_index
         for k, v in search_dict.items():
             if k == setting:
                 return True
@@ -1195,49 +2359,63 @@ class Roomba(object):
                     return True
         return False
 
-    def decode_payload(self, topic, payload):
+    def parse_payload(self, payload):
         '''
-        Format json for pretty printing, return string suitable for logging,
-        and a dict of the json data
+        decode json payload, None if it isn't json
         '''
-        indent = self.master_indent + 31 #number of spaces to indent json data
-
         try:
             # if it's json data, decode it (use OrderedDict to preserve keys
-            # order), else return as is...
-            json_data = json.loads(
+            # order), else return None...
+            return json.loads(
                 payload.decode("utf-8").replace(":nan", ":NaN").\
                 replace(":inf", ":Infinity").replace(":-inf", ":-Infinity"))  #removed object_pairs_hook=OrderedDict
+        except ValueError:
+            return None
+
+    def decode_payload(self, topic, payload, json_data=None):
+        '''
+        Format json for pretty printing, return string suitable for logging,
+        and a dict of the json data
+        json_data is the already decoded payload (from parse_payload), if any
+        '''
+        indent = self.master_indent + 31 #number of spaces to indent json data
+
+        if json_data is None:
+            json_data = self.parse_payload(payload)
+        if json_data is None:
+            formatted_data = payload
+        elif not isinstance(json_data, dict):
             # if it's not a dictionary, probably just a number
-            if not isinstance(json_data, dict):
-                return json_data, dict(json_data)
+            return json_data, dict(json_data)
+        else:
             json_data_string = "\n".join((indent * " ") + i for i in \
                 (json.dumps(json_data, indent = 2)).splitlines())
 
             formatted_data = "Decoded JSON: \n%s" % (json_data_string)
 
-        except ValueError:
-            formatted_data = payload
-
         if self.raw:
             formatted_data = payload
 
         return formatted_data, dict(json_data)
 
-    def decode_topics(self, state, prefix=None):
+    def decode_topics(self, state, prefix=None, changed=None, path=()):
         '''
         decode json data dict, and publish as individual topics to
         brokerFeedback/topic the keys are concatenated with _ to make one unique
         topic name strings are expressly converted to strings to avoid unicode
         representations
+        if changed (set of key paths from dict_merge) is given, only values
+        that have changed are published, None publishes everything
         '''
         for k, v in state.items():
             if isinstance(v, dict):
                 if prefix is None:
-                    self.decode_topics(v, k)
+                    self.decode_topics(v, k, changed, path + (k,))
                 else:
-                    self.decode_topics(v, prefix+"_"+k)
+                    self.decode_topics(v, prefix+"_"+k, changed, path + (k,))
             else:
+                if changed is not None and path + (k,) not in changed:
+                    continue
                 if isinstance(v, list):
                     newlist = []
                     for i in v:
@@ -1257,7 +2435,7 @@ class Roomba(object):
                 self.publish(k, str(v))
 
         if prefix is None:
-            self.update_state_machine()
+            self.update_state_machine(changed=changed)
             
     async def get_settings(self, items):
         result = {}
@@ -1285,10 +2463,40 @@ class Roomba(object):
         Only works correctly if property is a unique key
         '''
         if property in ['cleanSchedule', 'langs']:
-            value = self.recursive_lookup(self.master_state, property+'2', cap)
+            value = self.lookup_index(property+'2', cap)
             if value is not None:
                 return value
-        return self.recursive_lookup(self.master_state, property, cap)
+        return self.lookup_index(property, cap)
+
+    def lookup_index(self, key, cap=False):
+        '''
+        state_index equivalent of recursive_lookup(self.master_state, key, cap)
+        if cap is true, return key if it's in the (top level) 'cap' dictionary,
+        else return the first value of key found outside of 'cap', in the
+        same (depth first) order as recursive_lookup
+        '''
+        if cap:
+            paths = [path for path in self.state_index.get(key, {})
+                     if len(path) > 1 and path[0] == 'cap' and 'cap' not in path[1:-1]]
+        else:
+            paths = [path for path in self.state_index.get(key, {}) if 'cap' not in path[:-1]]
+        if not paths:
+            return None
+        if len(paths) > 1:
+            paths.sort(key=self.state_order)
+        return self.state_index[key][paths[0]]
+        
+    def state_order(self, path):
+        '''
+        position of path in a depth first walk of master_state, as a list of
+        key positions (for sorting paths)
+        '''
+        order = []
+        dct = self.master_state
+        for k in path:
+            order.append(list(dct).index(k))
+            dct = dct[k]
+        return order
         
     @property    
     def co_ords(self):
@@ -1407,24 +2615,27 @@ class Roomba(object):
         return False
             
     def handle_flags(self, flags=None, set=False):
-        self.master_state['state'].setdefault('flags', {})
+        # work on a copy, so state_index can be updated in one go
+        state_flags = dict(self.master_state['state'].get('flags', {}))
         if isinstance(flags, str):
             flags = [flags]
         if flags:
             for flag in flags:
                 if set:
-                    if not self.flag_set(flag):
+                    if not state_flags.get(flag, False):
                         self.flags[flag] = True
-                    self.master_state['state']['flags'].update(self.flags)
+                    state_flags.update(self.flags)
                 else:
                     self.flags.pop(flag, None)
-                    self.master_state['state']['flags'].pop(flag, None)
+                    state_flags.pop(flag, None)
         else:
             self.flags = {}
             if not set:
-                self.master_state['state']['flags'] = self.flags
+                state_flags = {}
+        self.set_state(('state', 'flags'), state_flags)
         
     def update_precent_complete(self):
+        self.percent_max_sqft = self.max_sqft
         try:
             sq_ft = self.get_property("sqft")
             if self.max_sqft and sq_ft is not None:
@@ -1501,7 +2712,7 @@ class Roomba(object):
             return self.sku[0].lower() in type
         return None
             
-    def update_state_machine(self, new_state = None):
+    def update_state_machine(self, new_state = None, changed=None):
         '''
         Roomba progresses through states (phases), current identified states
         are:
@@ -1568,6 +2779,9 @@ class Roomba(object):
         mission goes from 'none' to 'clean' (or another mission name) at start of mission (init map)
         mission goes from 'clean' (or other mission) to 'none' at end of missions (finalize map)
         Anything else = continue with existing map
+
+        changed is the set of key paths changed by the last update (None if
+        unknown), and is used to skip work for values that have not changed.
         '''
         if new_state is not None:
             self.current_state = self.states[new_state]
@@ -1575,14 +2789,20 @@ class Roomba(object):
             self.draw_map(True)
             return    
             
-        self.publish_error_message()                #publish error messages
-        self.update_precent_complete()
+        keys = None if changed is None else self.changed_keys(changed)
+        if keys is None or 'error' in keys:
+            self.publish_error_message()            #publish error messages
+        if keys is None or 'sqft' in keys or self.max_sqft != self.percent_max_sqft:
+            self.update_precent_complete()
         mission = self.update_history("cycle")      #mission
         phase = self.update_history("phase")        #mission phase
         self.update_history("pose")                 #update co-ordinates
         
         if self.cb is not None:                     #call callback if set
-            self.cb(self.master_state)
+            if self.cb_delta:
+                self.cb(self.master_state, changed)
+            else:
+                self.cb(self.master_state)
         
         if phase is None or mission is None:
             return
@@ -1712,7 +2932,10 @@ class Roomba(object):
         if type == 'npy':
             np.save(filename, var)
         else:
-            var.save(filename, type.upper())
+            data = self.encode_image(var, type)
+            self.frames.put(final_name if final_name else name, data, 'image/{}'.format(type))
+            with open(filename, 'wb') as f:
+                f.write(data)
  
         if final_name:
             new_filename = '{}/{}{}'.format(self.mapPath, self.roombaName, final_name)
@@ -1734,7 +2957,7 @@ class Roomba(object):
             self.base = self.make_blank_image(self.mapSize[0], self.mapSize[1])
             self.roomba_problem = self.make_blank_image()
 
-            self.previous_map_no_text = None
+            self.previous_map_generation = None
             self.map_no_text = self.load_image('map_notext.png', True)
         # save x and y center of image, for centering of final map image
         self.cx = self.base.size[0] // 2
@@ -1756,7 +2979,7 @@ class Roomba(object):
         '''
         needed because PIL pasting of transparent images gives weird results
         '''
-        image = self.make_blank_image()
+        image = self.make_blank_image(*base_image.size)
         image.paste(icon,position)
         base_image = Image.alpha_composite(base_image, image)
         return base_image
@@ -1764,17 +2987,26 @@ class Roomba(object):
     def img_to_png(self, name):
         '''
         convert name image to bytes in png format
-        if name is a string (not an image variable) attempt to load it
+        if name is a string (not an image variable) return the latest saved
+        image from frames, or attempt to load it
         return blank image if image is None
         '''
         if isinstance(name, str):
+            frame = self.frames.get(name)
+            if frame is not None and frame[2] == 'image/png':
+                return frame[0]
             name = self.load_image(name)
         if name is None:
             name = self.make_blank_image()
+        return self.encode_image(name)
+        
+    def encode_image(self, image, type='png'):
+        '''
+        return image encoded as bytes in type format
+        '''
         imgBytes = io.BytesIO()
-        name.save(imgBytes, format='PNG')
-        imgBytes.seek(0)
-        return imgBytes.read()
+        image.save(imgBytes, format=type.upper())
+        return imgBytes.getvalue()
 
     def zero_coords(self, theta=180):
         '''
@@ -1805,10 +3037,10 @@ class Roomba(object):
         '''
         calculate roomba position as list
         '''
-        return [x_y[0] - self.icons['roomba'].size[0] // 2,
-                x_y[1] - self.icons['roomba'].size[1] // 2,
-                x_y[0] + self.icons['roomba'].size[0] // 2,
-                x_y[1] + self.icons['roomba'].size[1] // 2]
+        return [x_y[0] - self.roomba_size[0] // 2,
+                x_y[1] - self.roomba_size[1] // 2,
+                x_y[0] + self.roomba_size[0] // 2,
+                x_y[1] + self.roomba_size[1] // 2]
 
     def draw_vacuum_lines(self, image, old_x_y, x_y, theta):
         '''
@@ -1862,7 +3094,7 @@ class Roomba(object):
         except Exception:
             return 0
             
-    def draw_roomba(self, roomba_pos, theta):
+    def draw_roomba(self, roomba_pos, theta, box=None):
         '''
         make a blank image for the text and Roomba overlay, initialized to
         transparent text color
@@ -1870,18 +3102,21 @@ class Roomba(object):
         Paste roomba icon onto roomba_sprite image
         Finally paste the dock icon over it
         add optional debug info, and return the new roomba_sprite image
+        if box is given, only the box area of the sprite image is returned
         '''
-        roomba_sprite = self.make_blank_image()
+        if box is None:
+            box = (0, 0) + self.base.size
+        roomba_sprite = self.make_blank_image(box[2] - box[0], box[3] - box[1])
         LOGGER.info("MAP: drawing roomba: pos: {}, theta: {}".format(roomba_pos, theta))
         
         #draw roomba
         roomba_sprite = self.transparent_paste(
             roomba_sprite,
-            self.icons['roomba'].rotate(theta, expand=False), roomba_pos)
+            self.icons.rotated('roomba', theta), self.offset_box(roomba_pos, box))
 
         # paste dock over roomba_sprite
         roomba_sprite = self.transparent_paste(
-            roomba_sprite, self.icons['home'], self.dock_position)
+            roomba_sprite, self.icons['home'], self.offset_box(self.dock_position, box))
             
         if self.debug:
             #draw bounding box, plus overlay co-ordinates on roomba_sprite
@@ -1894,23 +3129,91 @@ class Roomba(object):
             
         return roomba_sprite
         
-    def draw_problem_roombas(self, roomba_pos):
+    def offset_box(self, pos, box):
+        '''
+        offset position (x,y or box) relative to top left of box
+        '''
+        return tuple(v - box[i % 2] for i, v in enumerate(pos))
+
+    def bounding_box(self, boxes, pad=0):
+        '''
+        bounding box of boxes (or points), plus pad, clipped to the map
+        '''
+        boxes = [b for b in boxes if b is not None]
+        return (max(0, min(b[0] for b in boxes) - pad),
+                max(0, min(b[1] for b in boxes) - pad),
+                min(self.base.size[0], max(b[-2] for b in boxes) + pad),
+                min(self.base.size[1], max(b[-1] for b in boxes) + pad))
+
+    def get_static_layer(self):
+        '''
+        floorplan and room outline pre-merged, remade only when either changes
+        '''
+        layers = (self.floorplan, self.room_outline if self.roomOutline else None)
+        if self.static_layers is None or any(a is not b for a, b in zip(layers, self.static_layers)):
+            self.static_layer = None
+            for layer in layers:
+                if layer is not None:
+                    self.static_layer = layer if self.static_layer is None else Image.alpha_composite(self.static_layer, layer)
+            self.static_layers = layers
+        return self.static_layer
+
+    def composite_map(self, roomba_pos, theta, path=None):
+        '''
+        composite base, static layer (floorplan and room outline), roomba
+        sprite and problems into self.composite.
+        path is the old and new x,y drawn on base since the last call, if the
+        layers are otherwise unchanged, only the area covered by the path and
+        the old and new roomba sprite is recomposited. If path is None, the
+        whole map is.
+        returns the composite image
+        '''
+        static = self.get_static_layer()
+        layers = (self.base, self.roomba_problem, static)
+        if (path is None or self.debug or self.composite is None
+                or any(a is not b for a, b in zip(layers, self.composite_layers))):
+            out = self.base
+            if static is not None:
+                out = Image.alpha_composite(out, static)
+            #merge roomba and dock
+            out = Image.alpha_composite(out, self.draw_roomba(roomba_pos, theta))
+            #merge problem location for roomba into out
+            out = Image.alpha_composite(out, self.roomba_problem)
+            self.composite = out
+            self.composite_layers = layers
+            self.map_generation += 1
+        else:
+            box = self.bounding_box([roomba_pos, self.sprite_box] + list(path), self.icons['roomba'].size[0])
+            if box[0] < box[2] and box[1] < box[3]:
+                LOGGER.debug("MAP: compositing area: {}".format(box))
+                tile = self.base.crop(box)
+                if static is not None:
+                    tile = Image.alpha_composite(tile, static.crop(box))
+                tile = Image.alpha_composite(tile, self.draw_roomba(roomba_pos, theta, box))
+                tile = Image.alpha_composite(tile, self.roomba_problem.crop(box))
+                self.composite.paste(tile, box[:2])
+        self.sprite_box = roomba_pos
+        return self.composite
+
+    def draw_problem_roombas(self, roomba_pos, flags=None):
         '''
         Paste various Roomba problem icons onto the problems image
         '''
-        if self.flags.get('stuck'):
+        if flags is None:
+            flags = self.flags
+        if flags.get('stuck'):
             LOGGER.info("MAP: Drawing stuck Roomba")
             self.roomba_problem.paste(self.icons['stuck'],roomba_pos)
-        if self.flags.get('cancelled'):
+        if flags.get('cancelled'):
             LOGGER.info("MAP: Drawing cancelled Roomba")
             self.roomba_problem.paste(self.icons['cancelled'],roomba_pos)
-        if self.flags.get('bin_full'):
+        if flags.get('bin_full'):
             LOGGER.info("MAP: Drawing full bin")
             self.roomba_problem.paste(self.icons['bin full'],roomba_pos)
-        if self.flags.get('battery_low'):
+        if flags.get('battery_low'):
             LOGGER.info("MAP: Drawing low battery Roomba")
             self.roomba_problem.paste(self.icons['battery'],roomba_pos)
-        if self.flags.get('tank_low'):
+        if flags.get('tank_low'):
             LOGGER.info("MAP: Drawing tank low Braava")
             self.roomba_problem.paste(self.icons['tank low'],roomba_pos)
 
@@ -1940,8 +3243,79 @@ class Roomba(object):
     def render_map(self):
         '''
         Actually draw the map
+        The state handling is done here (make_frame), the drawing (draw_frame)
+        is done in map_executor if decode_inline or map_process is set
+        '''
+        frame = self.make_frame()
+        if frame is None or not any([frame['new_map'], frame['final_map'],
+                                     frame['save_text'] is not None, frame['draw']]):
+            return
+        if self.map_process:
+            self.submit_map_frame(frame)
+            return
+        if self.decode_inline:
+            if self.map_executor is None:
+                self.map_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='map_{}'.format(self.roombaName))
+            fut = self.map_executor.submit(self.draw_frame, frame)
+        else:
+            self.frame_drawn(self.draw_frame(frame))
+            return
+        fut.add_done_callback(lambda fut: self.loop.call_soon_threadsafe(self.frame_done, fut))
+
+    def submit_map_frame(self, frame):
+        '''
+        draw frame in the map worker process, frame None just collects the
+        images written since the last frame
+        '''
+        if self.map_executor is None:
+            # one process per Roomba, so frames are drawn in order on the same images.
+            # spawned, not forked, as forking a process with other threads running
+            # (paho, Polyglot) can copy a lock they hold, and deadlock the child
+            self.map_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        self.map_submitted += 1
+        fut = self.map_executor.submit(render_map_frame, self.roombaName,
+                                       self.debug, self.map_options, frame)
+        fut.add_done_callback(lambda fut: self.loop.call_soon_threadsafe(self.frame_done, fut))
+
+    def collect_map(self, submitted):
+        '''
+        collect a map held back by max_fps in the map worker process, unless
+        a frame has been submitted since (which collects it)
+        '''
+        if self.map_process and submitted == self.map_submitted:
+            self.submit_map_frame(None)
+
+    def frame_done(self, fut):
+        try:
+            self.frame_drawn(fut.result())
+        except concurrent.futures.CancelledError:
+            pass
+        except concurrent.futures.BrokenExecutor as e:
+            LOGGER.warning('MAP: map worker failed: {}, restarting'.format(e))
+            self.map_executor = None
+        except Exception as e:
+            LOGGER.exception(e)
+
+    def frame_drawn(self, result):
+        '''
+        handle the results of draw_frame
+        '''
+        if result.get('final'):
+            self.timer('update_after_completed', True, 3600)
+        for name, data in result.get('images', {}).items():
+            self.frames.put(name, data)
+        if result.get('retry'):
+            self.loop.call_later(result['retry'], self.collect_map, self.map_submitted)
+
+    def make_frame(self):
+        '''
+        Work out what to draw for the current state, update display text and
+        flags, and return a frame (dict) for draw_frame, or None
         '''
         draw_final = show_time =False
+        frame = {'new_map': False, 'final_map': False, 'save_text': None, 'draw': False}
         #save self.old_x_y
         old_x_y = self.old_x_y
         #get x,y theta location note: this updates self.old_x_y with new x_y
@@ -1959,18 +3333,18 @@ class Roomba(object):
             if self.is_set('update_after_completed'):
                 LOGGER.info('not updating map/text (mission complete), resume in {}s'.format(self.when_run('update_after_completed')))
             else:
-                self.save_text_and_map_on_whitebg(self.map_no_text)
+                frame['save_text'] = self.display_text
             draw_final = True
 
         elif self.current_state == self.states["recharge"]:
             x_y = None
             self.display_text = "Recharging: Time: {}m, Bat: {}%".format(self.rechrgM,self.batPct)
             self.clear_flags(['battery_low', 'stuck'])
-            self.save_text_and_map_on_whitebg(self.map_no_text)
+            frame['save_text'] = self.display_text
 
         elif self.current_state == self.states["pause"]:
             self.display_text = "Paused: {}m, Bat: {}%".format(self.mssnM,self.batPct)
-            self.save_text_and_map_on_whitebg(self.map_no_text)
+            frame['save_text'] = self.display_text
 
         elif self.current_state == self.states["hmPostMsn"]:
             self.display_text = "End Mission: Docking"
@@ -1987,7 +3361,7 @@ class Roomba(object):
             self.display_text = "Completed"
             show_time = True
             LOGGER.info("MAP: mission completed")
-            self.draw_final_map(True)
+            frame['final_map'] = True
             draw_final = True
             
         elif self.current_state == self.states["run"]:
@@ -1998,25 +3372,17 @@ class Roomba(object):
                 #bogus pose received, can't have 0,0,0 when running, usually happens after recovering from an error condition
                 LOGGER.warning('MAP: received 0,0,0 pose when running - ignoring')
                 self.old_x_y = None
-                return
+                return None
 
         elif self.current_state == self.states["stop"]:
             self.display_text = "Stopped: {}m, Bat: {}%".format(self.mssnM,self.batPct)
             self.show_final_map = False
 
         elif self.current_state == self.states["new"]:
-            self.angle = self.mapSize[4]    #reset angle
-            self.base = self.make_blank_image()
-            # overlay for roomba problem position
-            self.roomba_problem = self.make_blank_image()
-            # save x and y center of image, for centering of final map image
-            self.cx = self.base.size[0] // 2
-            self.cy = self.base.size[1] // 2                             
-            self.room_outline_contour = self.room_outline = None
+            frame['new_map'] = True
             self.show_final_map = False
             self.display_text = None
             self.timer('update_after_completed')
-            LOGGER.info("MAP: created new image at start of new run")
             self.clear_flags()
             self.set_flags('new_mission')
 
@@ -2025,7 +3391,7 @@ class Roomba(object):
             expire_text = 'Job Cancel in {}m'.format(expire) if expire else 'Job Cancelled'
             self.display_text = ("STUCK!: {} {}").format(self.error_message, expire_text)
             show_time = True
-            self.draw_final_map(True)
+            frame['final_map'] = True
             draw_final = True
             self.show_final_map = False
             self.set_flags('stuck')
@@ -2053,10 +3419,6 @@ class Roomba(object):
         else:
             LOGGER.warning("MAP: no special handling for state: {}".format(self.current_state))
 
-        if self.base is None:
-            LOGGER.warning("MAP: no image, exiting...")
-            return
-
         if self.display_text is None:
             self.display_text = self.current_state
             
@@ -2069,11 +3431,7 @@ class Roomba(object):
         
         if self.show_final_map and not self.debug: #just display final map - not live
             LOGGER.debug("MAP: not updating map - Roomba not running")
-            return
-
-        if self.debug:
-            # debug final map (careful, uses a lot of CPU power!)
-            self.draw_final_map()
+            return frame
             
         if x_y is None:
             #set zero co_ordinates if x_y is None
@@ -2086,35 +3444,80 @@ class Roomba(object):
 
         LOGGER.debug("MAP: old x,y: {} new x,y: {} theta: {} roomba pos: {}".format(old_x_y, x_y, theta, roomba_pos))
 
+        frame.update({'draw'        : True,
+                      'old_x_y'     : old_x_y,
+                      'x_y'         : x_y,
+                      'theta'       : theta,
+                      'roomba_pos'  : roomba_pos,
+                      'draw_final'  : draw_final,
+                      'flags'       : dict(self.flags),
+                      'display_text': self.display_text})
+        if draw_final:
+            self.show_final_map = True  # prevent re-drawing of map until reset
+        return frame
+
+    def draw_frame(self, frame):
+        '''
+        Draw the map for a frame from make_frame. Only this (and the methods it
+        calls) uses the map images, so it can be run in the map worker.
+        returns dict of results, 'final' is True if the final map was drawn
+        '''
+        result = {'final': False}
+        if frame['new_map']:
+            self.angle = self.mapSize[4]    #reset angle
+            self.base = self.make_blank_image()
+            # overlay for roomba problem position
+            self.roomba_problem = self.make_blank_image()
+            # save x and y center of image, for centering of final map image
+            self.cx = self.base.size[0] // 2
+            self.cy = self.base.size[1] // 2                             
+            self.room_outline_contour = self.room_outline = None
+            LOGGER.info("MAP: created new image at start of new run")
+
+        if self.base is None:
+            #checked here, as the map images belong to the map worker
+            LOGGER.warning("MAP: no image, exiting...")
+            return result
+
+        if frame['final_map']:
+            result['final'] = self.draw_final_map(True)
+
+        if frame['save_text'] is not None:
+            self.save_text_and_map_on_whitebg(self.map_no_text, frame['save_text'])
+
+        if not frame['draw']:
+            return result
+
+        if self.debug:
+            # debug final map (careful, uses a lot of CPU power!)
+            self.draw_final_map()
+
+        x_y = frame['x_y']
+        old_x_y = frame['old_x_y']
+        roomba_pos = frame['roomba_pos']
         #draw lines
-        self.draw_vacuum_lines(self.base, old_x_y, x_y, theta)
-        #draw roomba
-        roomba_sprite = self.draw_roomba(roomba_pos, theta)
+        self.draw_vacuum_lines(self.base, old_x_y, x_y, frame['theta'])
         #draw problem roombas
-        self.draw_problem_roombas(roomba_pos)
+        self.draw_problem_roombas(roomba_pos, frame['flags'])
         
         if self.roomOutline or self.auto_rotate:
             # draw room outline (saving results if this is a final map) update
             # x,y and angle if auto_rotate
-            self.draw_room_outline(draw_final, x_y)
-            
-        out = self.base
-        
-        #merge floorplan into base
-        if self.floorplan is not None:
-            out = Image.alpha_composite(out, self.floorplan)
-            
-        # merge room outline into base
-        if self.roomOutline:
-            out = Image.alpha_composite(out, self.room_outline)
+            self.draw_room_outline(frame['draw_final'], x_y)
             
-        #merge roomba lines (trail) with base
-        out = Image.alpha_composite(out, roomba_sprite)
-
-        #merge problem location for roomba into out
-        out = Image.alpha_composite(out, self.roomba_problem)
-
-        if draw_final and self.auto_rotate:
+        #merge layers, only the area that changed unless this is a final map
+        path = None if frame['draw_final'] or old_x_y is None else (old_x_y, x_y)
+        out = self.composite_map(roomba_pos, frame['theta'], path)
+        signature = (old_x_y, x_y, frame['theta'], sorted(frame['flags'].items()))
+        if signature != self.map_signature:
+            self.map_signature = signature
+            self.map_generation += 1
+        if (self.map_generation == self.previous_map_generation and
+                self.previous_display_text == frame['display_text']):
+            LOGGER.debug("MAP: map unchanged")
+            return result
+
+        if frame['draw_final'] and self.auto_rotate:
             #translate image to center it if auto_rotate is on
             out = self.transform_image(out)
             
@@ -2122,28 +3525,44 @@ class Roomba(object):
         #(NW 12/4/2018 fixed bug causing distorted maps when rotation is not 0)
         out_rotated = out.rotate(180, expand=False)
         # save composite image
-        self.save_text_and_map_on_whitebg(out_rotated)
-        if draw_final:
-            self.show_final_map = True  # prevent re-drawing of map until reset
+        self.save_text_and_map_on_whitebg(out_rotated, frame['display_text'])
+        return result
 
-    def save_text_and_map_on_whitebg(self, map):
+    def save_text_and_map_on_whitebg(self, map, display_text=None):
+        '''
+        queue map (and map with display_text) to be written by map_writer
+        map_generation is the version of map, so nothing is written if it and
+        display_text are unchanged.
+        '''
+        if display_text is None:
+            display_text = self.display_text
         # if no map or nothing changed
-        if map is None or (map == self.previous_map_no_text and
-                           self.previous_display_text == self.display_text):
+        if map is None or (self.map_generation == self.previous_map_generation and
+                           self.previous_display_text == display_text):
             return
         self.map_no_text = map
-        self.previous_map_no_text = self.map_no_text
-        self.previous_display_text = self.display_text
-        self.save_image(self.map_no_text, 'map_notext.png')
+        self.previous_map_generation = self.map_generation
+        self.previous_display_text = display_text
+        if self.map_writer is None:
+            self.map_writer = MapWriter(self.write_map, self.max_fps, 'map_writer_{}'.format(self.roombaName))
+        self.map_writer.submit(map, display_text)
+        
+    def write_map(self, map, display_text):
+        '''
+        write map and map with display_text on white background (runs in
+        map_writer thread). Files are written under a temporary name and
+        renamed, so readers never see a partial file
+        '''
+        self.save_image(map, '_map_notext.png', 'map_notext.png')
         
         if self.enableMapWithText:
-            final = self.make_blank_image(colour=(255,255,255,255))    # white
+            final = self.make_blank_image(*map.size, colour=(255,255,255,255))    # white
             # paste onto a white background, so it's easy to see
             final = Image.alpha_composite(final, map)
             #(NW 12/4/2018 fixed bug causing distorted maps when rotation is not 0 - moved rotate to here)
             final = final.rotate(self.angle, expand=True) 
             # draw text
-            self.draw_text(final, self.display_text, self.fnt)
+            self.draw_text(final, display_text, self.fnt)
             self.save_image(final, '_map.png', 'map.png')
 
     def ScaleRotateTranslate(self, image, angle=0, center=None, new_center=None,
@@ -2199,7 +3618,12 @@ class Roomba(object):
         else:   #PIL
             if self.room_outline is None:# or overwrite:
                 self.room_outline = self.load_image('room.png')
-            self.room_outline = self.make_new_outline_image()
+                self.outline_box = None
+            #like the contour test above, only remake it when x_y is outside it
+            box = self.outline_box
+            if overwrite or box is None or not (box[0] <= x_y[0] < box[2] and box[1] <= x_y[1] < box[3]):
+                self.room_outline = self.make_new_outline_image()
+                self.outline_box = self.room_outline.getchannel('A').getbbox()
 
         if overwrite or self.debug:
             # save room outline
@@ -2213,6 +3637,7 @@ class Roomba(object):
                     image=self.room_outline, contour=self.room_outline_contour,
                     final=overwrite)
                 self.room_outline = self.transform_image(self.room_outline)
+                self.outline_box = None
             LOGGER.info("MAP: Wrote new room outline files")
             
     def make_new_outline_image(self, contour=None):
@@ -2358,6 +3783,7 @@ class Roomba(object):
         '''
         draw map with outlines at end of mission. Called when mission has
         finished and Roomba has docked
+        returns True if base was replaced by the final map
         '''
         merge = self.make_blank_image()
         if HAVE_CV2:
@@ -2421,12 +3847,52 @@ class Roomba(object):
             merge = Image.alpha_composite(merge,edges)
         if overwrite:
             LOGGER.info("MAP: Drawing final map")
-            self.timer('update_after_completed', True, 3600)
             self.base=merge
 
         if self.debug:
             merge_rotated = merge.rotate(180+self.angle, expand=True)
             self.save_image(merge_rotated, 'final_map.png')
+        return overwrite
+
+class MapRenderer(Roomba):
+    '''
+    Draws maps for a Roomba in a map worker process (enable_map with
+    map_process=True). Only the map drawing part of Roomba is initialized,
+    frames come from Roomba.make_frame, saved images are returned to the
+    Roomba's frames.
+    '''
+    def __init__(self, roombaName, debug=False, **options):
+        self.roombaName = roombaName
+        self.debug = debug
+        self.address = None
+        self.roombas_config = {}
+        self.options = options
+        self.init_map()
+        self._enable_map(**options)
+
+    def render(self, frame):
+        '''
+        draw frame (None draws nothing), returns result of draw_frame with the
+        images saved since the last frame. The latest map is written now if
+        max_fps allows it, else 'retry' is the seconds until it is due, when
+        the Roomba collects it (see collect_map)
+        '''
+        result = {'final': False} if frame is None else self.draw_frame(frame)
+        result['retry'] = self.map_writer.flush() if self.map_writer is not None else 0
+        result['images'] = self.frames.pop_updated()
+        return result
+
+_map_renderers = {}     #MapRenderer by Roomba name, in map worker process
+
+def render_map_frame(roombaName, debug, options, frame):
+    '''
+    Runs in the map worker process, draws frame for roombaName and returns
+    the result of draw_frame, with the PNGs saved
+    '''
+    renderer = _map_renderers.get(roombaName)
+    if renderer is None or renderer.options != options or renderer.debug != debug:
+        renderer = _map_renderers[roombaName] = MapRenderer(roombaName, debug, **options)
+    return renderer.render(frame)
                 
 if __name__ == '__main__':
     from roomba_direct import main
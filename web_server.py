@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Python 3.7 Small HTTP server for Roomba map images
+
+Serves the latest images saved by Roomba (Roomba.frames) from memory, so
+dashboards can poll the map without touching the filesystem or re-encoding
+it. Supports ETag/If-None-Match, so an unchanged map costs a 304 response.
+
+GET /map.png (or /map_notext.png etc) returns the latest image
+GET / returns a json list of the available images
+'''
+
+import asyncio
+import json
+import udi_interface
+
+LOGGER = udi_interface.LOGGER
+
+class webserver(object):
+    '''
+    serve roomba.frames over http on webport, started by Roomba.setup_webserver
+    host defaults to localhost, use '' to listen on all interfaces
+    '''
+
+    VERSION = __version__ = "1.0"
+
+    reasons = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request',
+               404: 'Not Found', 405: 'Method Not Allowed'}
+
+    timeout = 30    #idle keep-alive connection timeout (s)
+
+    def __init__(self, roomba=None, webport=None, host='127.0.0.1'):
+        self.roomba = roomba
+        self.webport = webport
+        self.host = host
+        self.server = None
+        self.loop = roomba.loop if roomba else asyncio.get_event_loop()
+        self.loop.create_task(self.start())
+
+    async def start(self):
+        try:
+            self.server = await asyncio.start_server(self.handle, self.host, self.webport)
+            LOGGER.info('{} map server listening on {}:{}'.format(self.roomba.roombaName, self.host, self.webport))
+        except OSError as e:
+            LOGGER.error('Unable to start map server on {}:{}: {}'.format(self.host, self.webport, e))
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    async def handle(self, reader, writer):
+        '''
+        handle http connection, keep-alive is supported
+        '''
+        try:
+            while True:
+                request = await asyncio.wait_for(reader.readline(), self.timeout)
+                if not request:
+                    break
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), self.timeout)
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                try:
+                    method, path, version = request.decode('latin-1').split()
+                except ValueError:
+                    method = path = version = None
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                status, response_headers, body = self.respond(method, path, headers)
+                response_headers['Content-Length'] = str(len(body))
+                response_headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+                response = ['HTTP/1.1 {} {}'.format(status, self.reasons.get(status, ''))]
+                response.extend('{}: {}'.format(k, v) for k, v in response_headers.items())
+                writer.write(('\r\n'.join(response) + '\r\n\r\n').encode('latin-1'))
+                if method != 'HEAD':
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            LOGGER.exception(e)
+        finally:
+            writer.close()
+
+    def respond(self, method, path, headers):
+        '''
+        returns status, headers, body for request
+        '''
+        if path is None:
+            return 400, {}, b''
+        if method not in ('GET', 'HEAD'):
+            return 405, {'Allow': 'GET, HEAD'}, b''
+        name = path.split('?')[0].lstrip('/')
+        if not name:
+            return 200, {'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}, \
+                   json.dumps(self.roomba.frames.names()).encode('utf-8')
+        frame = self.roomba.frames.get(name)
+        if frame is None:
+            return 404, {}, b''
+        data, etag, content_type = frame
+        response_headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if_none_match = headers.get('if-none-match')
+        if if_none_match and (if_none_match.strip() == '*' or
+                              etag in [tag.strip() for tag in if_none_match.split(',')]):
+            return 304, response_headers, b''
+        response_headers['Content-Type'] = content_type
+        return 200, response_headers, data